@@ -0,0 +1,136 @@
+import os
+import random
+from datetime import datetime, timedelta
+import polars as pl
+
+# Synthetic databases with the searchingAPI schema. Categorical values are drawn from zipf-like distributions (a few
+# clients, methods and compounds account for most studies) and link tables fan out per study like scraped data does
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEPT', 'OCT', 'NOV', 'DEC']
+SPECIES = (['rat', 'mouse', 'rat and mouse', 'hamster', 'guinea pig'], [60, 30, 6, 2, 2])
+SEXES = (['males', 'females', 'both'], [45, 20, 35])
+STRAINS = ['Sprague Dawley', 'Wistar', 'Long Evans', 'Fischer 344', 'C57BL/6', 'BALB/c', 'CD-1', 'DBA/2', '129S', 'Swiss Webster',
+           'Syrian', 'Hartley', 'Lister Hooded', 'Brown Norway', 'Zucker', 'FVB', 'NOD', 'Nude', 'SCID', 'ICR']
+ROLES = ['Study Director', 'Principal Investigator', 'Veterinarian', 'QA', 'Technician']
+
+# link rows per study: {number of rows: weight}
+METHOD_FANOUT = {1: 10, 2: 25, 3: 25, 4: 15, 5: 10, 6: 7, 7: 5, 8: 3}
+COMPOUND_FANOUT = {0: 10, 1: 50, 2: 25, 3: 10, 4: 5}
+STRAIN_FANOUT = {1: 85, 2: 15}
+
+def zipf_weights(n, s = 1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+def repeat_ids(ids, rng, fanout):
+
+    # Each id repeated a number of times drawn from fanout
+
+    counts = rng.choices(list(fanout.keys()), weights = list(fanout.values()), k = len(ids))
+    return pl.DataFrame({'study_id': ids, 'n': counts}).select(pl.col('study_id').repeat_by('n')).explode('study_id').drop_nulls()
+
+def generate_tables(studies = 1000, seed = 0, clients = None, methods = None, compounds = None):
+
+    # Returns dict of {table: dataframe} for a database of the given number of studies. The number of distinct clients,
+    # methods and compounds grows with the number of studies unless given
+
+    rng = random.Random(seed)
+    clients = clients or max(20, int(studies ** 0.5))
+    methods = methods or min(400, max(30, studies // 50))
+    compounds = compounds or max(50, studies // 5)
+
+    client_names = [f'Client {i:04d}' for i in range(clients)]
+    client_codes = [f'C{i:04d}' for i in range(clients)]
+    method_names = [f'Method {i:03d}' for i in range(methods)]
+    compound_names = [f'CMPD-{i:06d}' for i in range(compounds)]
+
+    # studies
+    start = datetime(2005, 1, 1)
+    days = (datetime(2025, 12, 31) - start).days
+    client_idx = rng.choices(range(clients), weights = zipf_weights(clients), k = studies)
+    dates = [start + timedelta(days = rng.randrange(days)) for _ in range(studies)]
+    study_ids = [f'{client_codes[c]}_{i % 100:02d}_{d.day:02d}{MONTHS[d.month - 1]}{d.strftime("%y")}' for i, (c, d) in enumerate(zip(client_idx, dates))]
+    has_proposal = [rng.random() < 0.9 for _ in range(studies)]
+    has_report = [(not p) or (rng.random() < 0.7) for p in has_proposal]
+
+    study_tbl = pl.DataFrame({
+        'study_id': study_ids,
+        'study_number': [i % 100 for i in range(studies)],
+        'study_date': dates,
+        'client': [client_names[c] for c in client_idx],
+        'species': rng.choices(SPECIES[0], weights = SPECIES[1], k = studies),
+        'sex': rng.choices(SEXES[0], weights = SEXES[1], k = studies),
+        'description': [f'Synthetic study {i}' for i in range(studies)],
+        'proposal_id': [f'{s}_P00' if p else None for s, p in zip(study_ids, has_proposal)],
+        'proposal_issue_date': [d if p else None for d, p in zip(dates, has_proposal)],
+        'proposal_latest_reissue': [None] * studies,
+        'report_id': [f'{s}_R00' if r else None for s, r in zip(study_ids, has_report)],
+        'report_issue_date': [d + timedelta(days = 90) if r else None for d, r in zip(dates, has_report)],
+        'report_latest_reissue': [None] * studies,
+        'study_key': list(range(studies)),
+    }, schema_overrides = {'proposal_latest_reissue': pl.Datetime('us'), 'report_latest_reissue': pl.Datetime('us')})
+
+    # documents: the proposal and report of each study, with document keys
+    docs = pl.concat([
+        study_tbl.filter(pl.col('proposal_id').is_not_null()).select('study_id', 'study_key', pl.col('proposal_id').alias('document_id'), pl.lit('proposal').alias('document_type'),
+                                                                    pl.col('study_date').alias('created')),
+        study_tbl.filter(pl.col('report_id').is_not_null()).select('study_id', 'study_key', pl.col('report_id').alias('document_id'), pl.lit('report').alias('document_type'),
+                                                                  pl.col('report_issue_date').alias('created')),
+    ])
+    docs = docs.with_row_index('document_key').with_columns(
+        pl.col('document_key').cast(pl.Int64),
+        pl.lit(0).alias('document_number'),
+        (pl.col('document_id') + '.docx').alias('document_name'),
+        pl.lit('.docx').alias('ext'),
+        ('/Studies/' + pl.col('study_id')).alias('directory'),
+        pl.col('created').alias('last_modified'),
+        ('/Studies/' + pl.col('study_id') + '/' + pl.col('document_id') + '.docx').alias('filepath'),
+        pl.lit(1.0).alias('version'),
+    )
+    study_tbl = study_tbl.join(docs.filter(pl.col('document_type') == 'proposal').select(pl.col('document_id').alias('proposal_id'), pl.col('document_key').alias('proposal_key')),
+                               on = 'proposal_id', how = 'left')
+    study_tbl = study_tbl.join(docs.filter(pl.col('document_type') == 'report').select(pl.col('document_id').alias('report_id'), pl.col('document_key').alias('report_key')),
+                               on = 'report_id', how = 'left')
+    keys = study_tbl.select('study_id', 'study_key')
+
+    # link tables
+    study_methods = repeat_ids(study_ids, rng, METHOD_FANOUT)
+    study_methods = study_methods.with_columns(pl.Series('method', rng.choices(method_names, weights = zipf_weights(methods), k = len(study_methods))))
+    study_compounds = repeat_ids(study_ids, rng, COMPOUND_FANOUT)
+    study_compounds = study_compounds.with_columns(pl.Series('compound', rng.choices(compound_names, weights = zipf_weights(compounds, 0.8), k = len(study_compounds))))
+    study_strains = repeat_ids(study_ids, rng, STRAIN_FANOUT)
+    study_strains = study_strains.with_columns(pl.Series('strain', rng.choices(STRAINS, weights = zipf_weights(len(STRAINS)), k = len(study_strains))))
+    study_employees = pl.DataFrame({'study_id': study_ids}).join(pl.DataFrame({'role': ROLES}), how = 'cross')
+    study_employees = study_employees.with_columns(pl.Series('employee', [f'Employee {rng.randrange(200):03d}' for _ in range(len(study_employees))]))
+
+    tables = {
+        'studies': study_tbl,
+        'documents': docs,
+        'study_methods': study_methods.unique(maintain_order = True),
+        'study_compounds': study_compounds.unique(maintain_order = True),
+        'study_strains': study_strains.unique(maintain_order = True),
+        'study_employees': study_employees,
+        'scraped_files': docs.select('filepath', pl.lit(True).alias('success')),
+    }
+    for tbl in ['study_methods', 'study_compounds', 'study_strains', 'study_employees']:
+        tables[tbl] = tables[tbl].join(keys, on = 'study_id', how = 'left')
+    return tables
+
+def generate_database(folder, studies = 1000, seed = 0, storage = 'csv'):
+
+    # Writes a synthetic database to folder in the given storage format ('csv', 'parquet', 'ipc' or 'sqlite') and
+    # returns the number of rows per table
+
+    from custom_database import searchingAPI
+
+    os.makedirs(folder, exist_ok = True)
+    tables = generate_tables(studies, seed = seed)
+    for tbl, data in tables.items():
+        data.write_csv(os.path.join(folder, tbl + '.csv'))
+
+    if storage != 'csv':
+        db = searchingAPI(folder, storage = 'csv')
+        db.migrate_storage(storage, folder = folder)
+        for tbl in tables.keys():
+            os.remove(os.path.join(folder, tbl + '.csv'))
+
+    return {tbl: len(data) for tbl, data in tables.items()}
@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import warnings
+from datetime import datetime
+import polars as pl
+
+from benchmarks.generate import generate_database
+
+# Times the core CsvDatabase and searchingAPI operations on synthetic databases and writes the results to JSON,
+# optionally compared against a stored baseline, e.g.
+#   python -m benchmarks.run --studies 1000 10000 --out results.json
+#   python -m benchmarks.run --studies 1000 10000 --baseline results.json
+
+def timeit(fn, ops = 1):
+
+    # Run fn once, returns {'seconds', 'ops', 'per_op_ms'}
+
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'ops': ops, 'per_op_ms': elapsed * 1000 / ops}
+
+def run_scale(folder, storage = 'csv', lazy = False, lookups = 1000, writes = 1000, updates = 100, searches = 20, seed = 0):
+
+    # Times each operation on the database in folder. Returns {operation: timing}
+
+    from custom_database import searchingAPI, SearchCriteria
+
+    rng = random.Random(seed)
+    results = {}
+
+    api = None
+    def load():
+        nonlocal api
+        api = searchingAPI(folder, storage = storage, lazy = lazy)
+        api.load_all()
+    results['load'] = timeit(load)
+
+    study_ids = api.scan('studies').select('study_id').collect()['study_id'].to_list()
+    methods = api.get_possible_methods()
+    compounds = api.get_possible_compounds()
+    sample = [rng.choice(study_ids) for _ in range(lookups)]
+
+    results['get_entries'] = timeit(lambda: [api.get_entries('studies', {'study_id': s}) for s in sample], lookups)
+    results['get_entries_link'] = timeit(lambda: [api.get_entries('study_methods', {'study_id': s}) for s in sample], lookups)
+
+    new_rows = [{'study_id': rng.choice(study_ids), 'method': f'Benchmark method {i}'} for i in range(writes)]
+    results['write_entry'] = timeit(lambda: [api.write_entry('study_methods', row, key = row) for row in new_rows], writes)
+    results['write_entries'] = timeit(lambda: api.write_entries('study_compounds', [{'study_id': r['study_id'], 'compound': r['method']} for r in new_rows],
+                                                                key_cols = ['study_id', 'compound']))
+
+    targets = [rng.choice(study_ids) for _ in range(updates)]
+    results['update_field'] = timeit(lambda: [api.update_field('studies', {'study_id': s}, ('description', 'updated')) for s in targets], updates)
+
+    def filter_chain():
+        for i in range(searches):
+            api.create_filtered()
+            api.filter_by_method(methods[i % len(methods)])
+            api.filter_by_species('rat')
+            api.filter_by_date((2010, 2020))
+            api.get_matching_db()
+    results['filter_chain'] = timeit(filter_chain, searches)
+
+    def compound_chain():
+        for i in range(searches):
+            api.create_filtered()
+            api.filter_by_compound(compounds[i % len(compounds)])
+            api.filter_by_strain('Sprague Dawley')
+            api.filter_by_sex('males')
+            api.get_matching_db()
+    results['compound_chain'] = timeit(compound_chain, searches)
+
+    def matching_docs():
+        for i in range(searches):
+            api.create_filtered()
+            api.filter_by_method(methods[i % len(methods)])
+            api.get_matching_docs()
+    results['get_matching_docs'] = timeit(matching_docs, searches)
+
+    criteria = [SearchCriteria(methods = [methods[i % len(methods)]], species = 'rat', sex = 'males', years = (2010, 2020)) for i in range(searches)]
+    results['search_docs'] = timeit(lambda: [api.search_docs(c) for c in criteria], searches)
+
+    results['save_all_tbls'] = timeit(api.save_all_tbls)
+    return results
+
+def compare(results, baseline, threshold = 1.1):
+
+    # Ratio of each operation's time to the baseline's. Returns list of (scale, operation, baseline s, current s, ratio)
+    # and the operations slower than threshold
+
+    rows = []
+    regressions = []
+    for scale, ops in results['results'].items():
+        for op, timing in ops.items():
+            base = baseline.get('results', {}).get(scale, {}).get(op)
+            if base is None:
+                continue
+            ratio = timing['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+            rows.append((scale, op, base['seconds'], timing['seconds'], ratio))
+            if ratio > threshold:
+                regressions.append((scale, op, ratio))
+    return rows, regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark CsvDatabase and searchingAPI on synthetic databases')
+    parser.add_argument('--studies', type = int, nargs = '+', default = [1000, 10000], help = 'database scales to run (number of studies)')
+    parser.add_argument('--storage', default = 'csv', choices = ['csv', 'parquet', 'ipc', 'sqlite'])
+    parser.add_argument('--lazy', action = 'store_true', help = 'open searchingAPI with lazy = True')
+    parser.add_argument('--lookups', type = int, default = 1000)
+    parser.add_argument('--writes', type = int, default = 1000)
+    parser.add_argument('--updates', type = int, default = 100)
+    parser.add_argument('--searches', type = int, default = 20)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--folder', default = None, help = 'keep generated databases in this folder (default: temporary)')
+    parser.add_argument('--out', default = 'benchmark_results.json')
+    parser.add_argument('--baseline', default = None, help = 'results JSON to compare against')
+    parser.add_argument('--threshold', type = float, default = 1.1, help = 'slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    results = {
+        'meta': {'date': datetime.now().isoformat(), 'python': platform.python_version(), 'polars': pl.__version__, 'platform': platform.platform(),
+                 'storage': args.storage, 'lazy': args.lazy, 'seed': args.seed},
+        'results': {},
+        'rows': {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.folder or tmp
+        for studies in args.studies:
+            folder = os.path.join(root, f'{args.storage}_{studies}')
+            t = time.perf_counter()
+            results['rows'][str(studies)] = generate_database(folder, studies, seed = args.seed, storage = args.storage)
+            print(f'{studies} studies generated in {time.perf_counter() - t:.1f}s')
+
+            results['results'][str(studies)] = run_scale(folder, storage = args.storage, lazy = args.lazy, lookups = args.lookups, writes = args.writes,
+                                                         updates = args.updates, searches = args.searches, seed = args.seed)
+            for op, timing in results['results'][str(studies)].items():
+                print(f'  {op:<20} {timing["seconds"]:>9.3f}s  {timing["per_op_ms"]:>10.3f} ms/op')
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent = 1)
+    print(f'Results written to {args.out}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(results, baseline, args.threshold)
+        print(f'\n{"scale":>8} {"operation":<20} {"baseline":>10} {"current":>10} {"ratio":>7}')
+        for scale, op, base, current, ratio in rows:
+            print(f'{scale:>8} {op:<20} {base:>9.3f}s {current:>9.3f}s {ratio:>7.2f}')
+        if len(regressions):
+            print(f'\n{len(regressions)} operations slower than {args.threshold}x baseline')
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,9 +3,9 @@ import polars as pl
 import os
 from PyQt5.QtWidgets import QApplication, QLabel, QVBoxLayout, QHBoxLayout, QWidget, QStackedLayout, QComboBox, QLineEdit, QCompleter, QListWidget, QAbstractItemView, QSpinBox, QPushButton, QMessageBox, QScrollArea, QSpacerItem, QSizePolicy
 from PyQt5.QtGui import QDesktopServices
-from PyQt5.QtCore import  Qt, QUrl
+from PyQt5.QtCore import  Qt, QUrl, QTimer
 
-from custom_database import searchingAPI
+from custom_database import searchingAPI, SearchCriteria
 
 # function to generate URL from filepath
 def generate_link_html(file_path):
@@ -18,7 +18,7 @@ class MainWindow(QWidget):
     def __init__(self):
         super().__init__()
 
-        self.api  = searchingAPI("/Database")
+        self.api  = searchingAPI("/Database", lazy = True)
         # self.api = searchingAPI("/Users/rebeccakrall/Desktop/Database4")
 
         # initialize all search parameters
@@ -34,6 +34,12 @@ class MainWindow(QWidget):
         self.upper_year = self.maxyear
         self.filepaths = []
         self.initUI()
+        self.update_counts()
+
+        # pick up database changes saved by other users
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.api.refresh)
+        self.refresh_timer.start(60000)
 
     def initUI(self):
         self.setWindowTitle('Comps Finder')
@@ -211,6 +217,7 @@ class MainWindow(QWidget):
         self.methods_list = [item.text() for item in self.method_combo.selectedItems()]
         if len(self.methods_list) == 0:
             self.methods_list = None
+        self.update_counts()
 
     def heading_choice(self):
         self.methods_str = self.heading_edit.text()
@@ -221,90 +228,76 @@ class MainWindow(QWidget):
         self.cmpd_list = [item.text() for item in self.cmpds_combo.selectedItems()]
         if len(self.cmpd_list) == 0:
             self.cmpd_list = None
+        self.update_counts()
     
     def client_choice(self):
         self.client = self.client_combo.currentText()
         if self.client == "":
             self.client = None
+        self.update_counts()
 
     def species_choice(self):
         self.species = self.species_combo.currentText()
         if self.species == "":
             self.species = None
+        self.update_counts()
 
     def sex_choice(self):
         self.sex = self.sex_combo.currentText()
         if self.sex == "":
             self.sex = None
+        self.update_counts()
 
     def strain_choice(self):
         self.strain = self.strain_combo.currentText()
         if self.strain == "":
             self.strain = None
+        self.update_counts()
 
     def update_lower(self):
         self.lower_year = self.lower.value()
         self.upper.setRange(self.lower.value(), self.maxyear)
+        self.update_counts()
     
     def update_upper(self):
         self.upper_year = self.upper.value()
         self.lower.setRange(self.minyear, self.upper.value())
+        self.update_counts()
     
-    def search_docs(self):    
-        
-        self.api.create_filtered()
-        if self.methods_list is not None:
-            for method in self.methods_list:
-                self.api.filter_by_method(method)
-                
-                if self.api.check_filter_empty():
-                    QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                    return
-              
-
-        if self.cmpd_list is not None:
-           for c in self.cmpd_list:
-                self.api.filter_by_compound(c)
-                
-                if self.api.check_filter_empty():
-                    QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                    return
-        
-        
-        if self.client is not None:
-            self.api.filter_by_client(self.client)
-            if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
-       
-        if self.sex is not None:
-            self.api.filter_by_sex(self.sex)
-            if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
-        
-        if self.strain is not None:
-            self.api.filter_by_strain(self.strain)
-            if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
-        
-        if self.species is not None:
-            self.api.filter_by_species(self.species)
-            if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
-            
-
-        self.api.filter_by_date((self.lower_year, self.upper_year))
-        if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
+    def search_criteria(self):
+        return SearchCriteria(methods = self.methods_list, compounds = self.cmpd_list, client = self.client, sex = self.sex, 
+                              species = self.species, strain = self.strain, years = (self.lower_year, self.upper_year))
+
+    def update_counts(self):
+
+        # Show how many studies each option would match with the current choices and grey out options with none, 
+        # so dead combinations aren't found by trial and error. Selected options stay enabled so they can be cleared
+
+        counts = self.api.facet_counts(self.search_criteria())
+        for widget, field in [(self.method_combo, 'method'), (self.cmpds_combo, 'compound')]:
+            for i in range(widget.count()):
+                item = widget.item(i)
+                count = counts.get(field, {}).get(item.text(), 0)
+                item.setToolTip(f'{count} studies')
+                if count or item.isSelected():
+                    item.setFlags(item.flags() | Qt.ItemIsEnabled)
+                else:
+                    item.setFlags(item.flags() & ~Qt.ItemIsEnabled)
+
+        for combo, field in [(self.client_combo, 'client'), (self.species_combo, 'species'), (self.sex_combo, 'sex'), (self.strain_combo, 'strain')]:
+            for i in range(combo.count()):
+                if combo.itemText(i) == "":
+                    continue
+                count = counts.get(field, {}).get(combo.itemText(i), 0)
+                combo.setItemData(i, f'{count} studies', Qt.ToolTipRole)
+                combo.model().item(i).setEnabled((count > 0) or (i == combo.currentIndex()))
 
+    def search_docs(self):    
         
-            # self.found_docs = fin
-
-        self.filepaths = self.api.get_matching_docs()
+        self.filepaths = self.api.search_docs(self.search_criteria())
+        if (self.filepaths is None) or self.filepaths.is_empty():
+            QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
+            return
         
         for row in self.filepaths.iter_rows():
             # row[0] = study id
@@ -338,7 +331,7 @@ class MainWindow(QWidget):
         self.upper.setValue(self.maxyear)
         self.lower.setValue(self.minyear)
         self.stacked_layout.setCurrentIndex(0)
-        self.api.create_filtered()
+        self.update_counts()
         # self.doc_ref = pl.read_excel("all_filename_detail_050442.xlsx")
      
     def clearLayout(self, layout):
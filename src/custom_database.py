@@ -1,7 +1,26 @@
 import os
+import io
+import time
+import inspect
+import json
+import socket
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, contextmanager
 import polars as pl
 import warnings
-from datetime import datetime
+from datetime import datetime, date
+from functools import lru_cache, wraps
+from collections import deque, OrderedDict
+from bisect import bisect_left
+
+# polars dtypes used to store the python types found in table schemas
+DTYPES = {str: pl.String, int: pl.Int64, float: pl.Float64, bool: pl.Boolean, datetime: pl.Datetime('us'), date: pl.Date}
+
+# Low-cardinality columns are declared pl.Categorical in API schemas. With one global string cache their codes match 
+# across tables and loads, so joins, concats and filters on them compare integers without re-encoding
+pl.enable_string_cache()
 
 
 def dict_from_cols(cols, data_row):
@@ -13,37 +32,384 @@ def dict_from_cols(cols, data_row):
             data[c] = None
     return data
 
+def cast_series(series, dtype):
+
+    # Cast a series to a polars dtype without raising. Returns the casted series and a boolean mask of values 
+    # that were not null before casting but are after (i.e. failed to cast)
+
+    if (dtype is None) or (series.dtype == dtype):
+        return series, None
+
+    try:
+        casted = series.cast(dtype, strict = False)
+    except Exception:
+        if (series.dtype == pl.String) and (dtype == pl.Boolean):
+            casted = series.str.to_lowercase().replace_strict({'true': True, 'false': False}, default = None, return_dtype = pl.Boolean)
+        else:
+            casted = pl.Series(series.name, [None] * len(series), dtype = dtype)
+
+    # strings in formats other than ISO are parsed rather than cast
+    if (series.dtype == pl.String) and (dtype in (pl.Datetime, pl.Date)) and (casted.null_count() > series.null_count()):
+        try:
+            if dtype == pl.Date:
+                parsed = series.str.to_date(strict = False)
+            else:
+                parsed = series.str.to_datetime(time_unit = 'us', strict = False).cast(dtype)
+            casted = casted.fill_null(parsed)
+        except Exception:
+            pass
+
+    return casted, casted.is_null() & series.is_not_null()
+
+class TableSchema():
+
+    # Table schema compiled once from a dict of {column: python type or polars dtype}. Holds the polars dtype and python
+    # type for each column and casts dicts or dataframes through polars. Values that fail to cast become null and are 
+    # reported as a mask instead of raising.
+
+    def __init__(self, schema):
+        self.dtypes = {}
+        self.types = {}
+        for col, scheme in schema.items():
+            if (type(scheme) == type) and (scheme in DTYPES):
+                self.dtypes[col] = DTYPES[scheme]
+                self.types[col] = scheme
+            elif isinstance(scheme, pl.DataType) or (type(scheme) == pl.datatypes.classes.DataTypeClass):
+                self.dtypes[col] = scheme
+                try:
+                    self.types[col] = scheme.to_python()
+                except Exception:
+                    self.types[col] = None
+            else:
+                self.dtypes[col] = None
+                self.types[col] = scheme
+
+    def cast_dict(self, data):
+
+        # Casts values (scalars or lists) in place. Returns data and dict of {column: values that failed to cast}
+
+        failed = {}
+        for k, v in data.items():
+            if (k not in self.dtypes) or (self.dtypes[k] is None):
+                continue
+
+            python_type = self.types[k]
+            if type(v) == list:
+                if all((elem is None) or (type(elem) == python_type) for elem in v):
+                    continue
+                series = pl.Series(k, v, strict = False)
+            elif (v is None) or (type(v) == python_type):
+                continue
+            else:
+                series = pl.Series(k, [v], strict = False)
+
+            casted, mask = cast_series(series, self.dtypes[k])
+            if (mask is not None) and mask.any():
+                failed[k] = series.filter(mask).to_list()
+
+            if type(v) == list:
+                data[k] = casted.to_list()
+            else:
+                data[k] = casted[0]
+
+        return data, failed
+
+    def cast_frame(self, data):
+
+        # Casts columns of a dataframe in one pass. Returns data and a dataframe mask of values that failed to cast
+        # (only columns that needed casting are included, None if no columns did)
+
+        casts = []
+        masks = []
+        for col, dtype in self.dtypes.items():
+            if (col in data.columns) and (dtype is not None) and (data.schema[col] != dtype):
+                casted, mask = cast_series(data[col], dtype)
+                casts.append(casted.alias(col))
+                masks.append(mask.alias(col))
+        
+        if len(casts):
+            return data.with_columns(casts), pl.DataFrame(masks)
+        else:
+            return data, None
+
+    def scan_exprs(self, columns, keep_extra = False):
+
+        # Expressions casting the columns of a file scan (a polars schema of the file) to the schema. String columns
+        # (all columns of a csv scan) are parsed, typed columns are cast only if they differ. Schema columns missing 
+        # from the file are added as nulls, extra columns are dropped unless keep_extra
+
+        exprs = []
+        for col, dtype in self.dtypes.items():
+            if col not in columns:
+                exprs.append(pl.lit(None, dtype = dtype).alias(col))
+            elif (dtype is None) or (columns[col] == dtype):
+                exprs.append(pl.col(col))
+            elif columns[col] != pl.String:
+                exprs.append(pl.col(col).cast(dtype, strict = False))
+            elif dtype == pl.Boolean:
+                exprs.append(pl.col(col).str.to_lowercase().replace_strict({'true': True, 'false': False}, default = None, return_dtype = pl.Boolean))
+            elif dtype == pl.Datetime:
+                exprs.append(pl.coalesce(pl.col(col).cast(dtype, strict = False), pl.col(col).str.to_datetime(time_unit = 'us', strict = False)).alias(col))
+            elif dtype in (pl.Int64, pl.Int32):
+                # integers written from float columns (e.g. '1.0') are still read
+                exprs.append(pl.col(col).cast(pl.Float64, strict = False).cast(dtype, strict = False))
+            else:
+                exprs.append(pl.col(col).cast(dtype, strict = False))
+
+        if keep_extra:
+            exprs.extend(pl.col(col) for col in columns.names() if col not in self.dtypes)
+        return exprs
+
+def entries_as_dict(entries):
+
+    # Dict of a single entry's values, of lists of values if several entries, or of None if no entries
+
+    if len(entries) > 1:
+        return entries.to_dict(as_series = False)
+    elif len(entries) == 1:
+        return {k:v[0] for k,v in entries.to_dict(as_series = False).items()}
+    else:
+        return {k:None for k in entries.columns}
+
+# Latest durations kept per method for percentiles while instrumentation is enabled
+STATS_SAMPLES = 10000
+
+# Chunks a table frame may be split into by merged buffers before it is rechunked (see CsvDatabase.flush)
+MAX_CHUNKS = 16
+
+def match_mask(data, expr):
+
+    # Boolean series of the rows matching expr. Rows where expr is null (e.g. comparing a null key column) don't match
+
+    return data.with_columns(expr.fill_null(False).alias('__match')).get_column('__match')
+
+def percentile(samples, q):
+    if len(samples):
+        return samples[int(q * (len(samples) - 1))]
+    else:
+        return None
+
+def timed(method):
+
+    # Records calls and durations of a database method while instrumentation is enabled (see CsvDatabase.enable_stats).
+    # Costs one attribute check per call otherwise
+
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.stats is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.record_timing(name, time.perf_counter() - start)
+    return wrapper
+
+@lru_cache(maxsize = None)
+def _compile_schema(items):
+    return TableSchema(dict(items))
+
+def compile_schema(schema):
+
+    # Compiled schemas are cached by content, so tables sharing a schema (or a schema that hasn't changed) compile once
+
+    return _compile_schema(tuple(schema.items()))
+
+class CsvStorage():
+
+    # Storage backends read, scan and write one table per file. CSV is the default, readable by anything,
+    # but every load reparses text and reinfers types.
+
+    ext = '.csv'
+    memory_mapped = False
+
+    def read(self, path):
+        return pl.read_csv(path)
+
+    def scan(self, path):
+        return pl.scan_csv(path, infer_schema = False)
+
+    def read_schema(self, path, sample = 100):
+        # header plus a sample of rows
+        return pl.scan_csv(path, infer_schema_length = sample).collect_schema()
+
+    def write(self, frame, path):
+        frame.write_csv(path)
+
+class ParquetStorage():
+
+    # Typed, zstd compressed columnar files. Much smaller than CSV on the network share and loaded without parsing
+
+    ext = '.parquet'
+    memory_mapped = False
+
+    def read(self, path):
+        return pl.read_parquet(path)
+
+    def scan(self, path):
+        return pl.scan_parquet(path)
+
+    def read_schema(self, path, sample = 100):
+        return pl.read_parquet_schema(path)
+
+    def write(self, frame, path):
+        frame.write_parquet(path, compression = 'zstd')
+
+class IpcStorage():
+
+    # Uncompressed Arrow IPC files, memory-mapped on load so tables are read without copying
+
+    ext = '.arrow'
+    memory_mapped = True
+
+    def read(self, path):
+        return pl.read_ipc(path, memory_map = True)
+
+    def scan(self, path):
+        return pl.scan_ipc(path, memory_map = True)
+
+    def read_schema(self, path, sample = 100):
+        return pl.read_ipc_schema(path)
+
+    def write(self, frame, path):
+        # a memory-mapped file must not be rewritten in place, CsvDatabase writes a new file and renames it over the old
+        frame.write_ipc(path, compression = 'uncompressed')
+
+# Storage of the study database folder (searchingAPI and buildingAPI) when none is given, so applications can switch its
+# backend with configuration only. Reference data and other CsvDatabase folders stay csv unless storage is given
+DEFAULT_STORAGE = os.environ.get('DATABASE_STORAGE', 'csv')
+
+STORAGE = {'csv': CsvStorage(), 'parquet': ParquetStorage(), 'ipc': IpcStorage()}
+
+# python types that can be saved in the inferred schema cache, by name
+SCHEMA_CACHE_TYPES = {t.__name__: t for t in [str, int, float, bool, datetime, date, type(None)]}
+SCHEMA_CACHE_FN = '.schema_cache.json'
+
+def encode_log_value(value):
+
+    # json default for change log entries
+
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    elif isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    raise TypeError(f'{type(value)} can not be written to the change log')
+
+def decode_log_value(obj):
+
+    # json object_hook for change log entries
+
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    elif '__date__' in obj:
+        return date.fromisoformat(obj['__date__'])
+    return obj
+
+class FileLock():
+
+    # Advisory lock shared between processes, including users on other machines working in the same network folder.
+    # Holding the lock means having created the lock file exclusively. Locks older than stale seconds are assumed 
+    # to belong to a crashed process and are broken.
+
+    def __init__(self, path, timeout = 30, stale = 300):
+        self.path = path
+        self.timeout = timeout
+        self.stale = stale
+
+    def acquire(self):
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(f'{socket.gethostname()} {os.getpid()} {datetime.now().isoformat()}')
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                
+                if time.time() - start > self.timeout:
+                    raise TimeoutError(f'{self.path} is locked by another user')
+                time.sleep(0.1)
+
+    def release(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
 class CsvDatabase():
 
     # Base class for API's to handle scraping & searching data. 
     # 092524: Checked CsvDatabase functions, 092724: Function testing and refinement
 
-    def __init__(self, folder, schema = None, strict = False, expand_tbls = False, expand_fields = False):
+    def __new__(cls, *args, **kwargs):
+
+        # storage = 'sqlite' swaps in the SQL backend, for CsvDatabase and the API's built on it
+
+        try:
+            bound = inspect.signature(cls.__init__).bind(None, *args, **kwargs)
+            bound.apply_defaults()
+            storage = bound.arguments.get('storage')
+        except TypeError:
+            storage = None
+
+        if storage == 'sqlite':
+            from sql_database import sql_backend
+            cls = sql_backend(cls)
+        return super().__new__(cls)
+
+    def __init__(self, folder, schema = None, strict = False, expand_tbls = False, expand_fields = False, indexes = None, buffer_size = 1000, lazy = False, 
+                 storage = None, write_log = False, shared = False, memory_budget = None):
 
         # folder: filepath for folder containing csv files that will be used to build a database
         # schema: dict of dict containing schema for each intended table
         # strict: for polars kwargs - coercing datatypes
         # expand_tbls: boolean - tables found in folder but not in schema should be included (if False, these tables are not loaded)
         # expand_fields: boolean - fields found in csv files but not in schema should be included (if False, these fields are not loaded)
+        # indexes: dict of lists - key columns (str or tuple of str) to hash index per table, e.g. {'documents': ['filepath', ('study_id', 'document_type')]}
+        # buffer_size: int - number of appended rows held per table before they are merged into the table frame
+        # lazy: boolean - queries scan csv files (pushing filters and column selection into the read) instead of loading whole tables.
+        #       Tables are still loaded in full the first time they are written to.
+        # storage: str - file format tables are stored in: 'csv', 'parquet' or 'ipc' (see STORAGE), or 'sqlite' to keep all tables in 
+        #       an embedded database file (see SqlDatabase). Defaults to 'csv'. Use migrate_storage to convert a folder
+        # write_log: boolean - saving appends inserts, updates and deletes to a change log next to each table instead of rewriting
+        #       the table file. Logs are replayed on load and folded into the table file with compact()
+        # shared: boolean - the folder is used by several processes at once. Saves take a lock file per table and, if the table
+        #       changed on disk since it was loaded, merge entries others added instead of overwriting them
+        # memory_budget: int - bytes loaded tables may take up. When they are over budget after a save or at the start of a read, the least
+        #       recently used tables without unsaved changes are unloaded and read from file again when next needed (see enforce_budget and pinned)
 
         # Assumption: Anything in schema should be in database. If extra data exists, it can be loaded using expand bools. If schema outlines 
         # data not in the folder, create empty table for them.
 
+        if storage is None:
+            storage = 'csv'
+        if type(storage) == str:
+            storage = STORAGE[storage]
+        self.storage = storage
+
         if os.path.isdir(folder) & os.path.exists(folder):
-            all_csvs = [fn for fn in os.listdir(folder) if fn.endswith('.csv')]
+            all_csvs = [fn for fn in os.listdir(folder) if fn.endswith(storage.ext)]
         elif os.path.isfile(folder) & os.path.exists(folder):
             all_csvs = [folder]
         else:
             Exception(f"{folder} not found")
 
-        self.init_dir = folder
-        self.schema = schema
-        self.strict = strict
-        self.expand_fields = expand_fields
-        self.database = {}
-        self.reference = {}
-        if not self.schema:
-            self.schema = {}
+        self._init_state(folder, schema, strict, expand_fields, buffer_size, lazy, write_log, shared, memory_budget)
 
         for fn in all_csvs:
             name, _ = os.path.splitext(fn)
@@ -65,63 +431,131 @@ class CsvDatabase():
             add_tbls = [x for x in schema.keys() if x not in self.schema.keys()]
             for tbl in add_tbls:
                 self.create_tbl(name, schema = schema[tbl])
+
+        if indexes:
+            for tbl, cols in indexes.items():
+                for c in cols:
+                    self.add_index(tbl, c)
+
+        self.save_schema_cache()
     
+    def _init_state(self, folder, schema, strict, expand_fields, buffer_size, lazy, write_log, shared, memory_budget):
+
+        # Attributes every backend starts with, before its tables are added (see __init__ for the arguments)
+
+        self.init_dir = folder
+        self.schema = schema if schema else {}
+        self.strict = strict
+        self.expand_fields = expand_fields
+        self.database = {}
+        self.reference = {}
+        self.index_cols = {}
+        self.indexes = {}
+        self.pending = {}
+        self.pending_rows = {}
+        self.buffer_size = buffer_size
+        self.lazy = lazy
+        self.write_log = write_log
+        self.changes = {}
+        self.replaying = set()
+        self.versions = {}
+        self.saved_versions = {}
+        self.load_locks = {}
+        self.locks_lock = threading.Lock()
+        self.executor = None
+        self.file_stamps = {}
+        self.shared = shared
+        self.bases = {}
+        self.transaction_state = None
+        self.key_templates = {}
+        self.stats = None
+        self.stats_lock = threading.Lock()
+        self.memory_budget = memory_budget
+        self.recent = OrderedDict()
+        self.budget_lock = threading.Lock()
+        self.pins = {}
+        self.schema_cache = None
+
     def infer_schema(self, tbl):
-        data = pl.read_csv(self.reference[tbl])
-        return pl.Schema(data.schema).to_python()
+
+        # Schema inferred from the file header and a sample of rows rather than a full read. Inferred schemas are
+        # cached in a file in the folder, keyed by each table's modification time and size, so unchanged tables aren't reopened
+
+        path = self.reference[tbl]
+        stat = os.stat(path)
+        cache = self.load_schema_cache()
+        cached = cache.get(os.path.basename(path))
+        if cached and (cached['mtime'] == stat.st_mtime_ns) and (cached['size'] == stat.st_size):
+            return {k: SCHEMA_CACHE_TYPES[v] for k,v in cached['schema'].items()}
+
+        schema = pl.Schema(self.storage.read_schema(path)).to_python()
+        if all(t in SCHEMA_CACHE_TYPES.values() for t in schema.values()):
+            cache[os.path.basename(path)] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'schema': {k: t.__name__ for k,t in schema.items()}}
+            self.schema_cache_changed = True
+        return schema
+
+    def load_schema_cache(self):
+        if self.schema_cache is None:
+            self.schema_cache = {}
+            self.schema_cache_changed = False
+            cache_fn = os.path.join(self.init_dir, SCHEMA_CACHE_FN)
+            if os.path.isdir(self.init_dir) and os.path.exists(cache_fn):
+                try:
+                    with open(cache_fn) as f:
+                        self.schema_cache = json.load(f)
+                except (OSError, ValueError):
+                    warnings.warn(f'Could not read {cache_fn}, schemas will be inferred')
+        return self.schema_cache
+
+    def save_schema_cache(self):
+
+        # Written to a temporary file of this process and renamed over the cache, so processes opening the folder at once
+        # never leave a partly written cache for others to read
+
+        if (self.schema_cache is not None) and self.schema_cache_changed and os.path.isdir(self.init_dir):
+            path = os.path.join(self.init_dir, SCHEMA_CACHE_FN)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.schema_cache, f, indent = 1)
+                os.replace(tmp_path, path)
+                self.schema_cache_changed = False
+            except OSError:
+                # read-only folders just don't get a cache
+                pass
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
     
+    @timed
     def match_schema(self, data, schema):
 
         # Match datatypes between data and schema. Data can be a polars dataframe or dict.
+        # Values that fail to cast are set to null and reported in a single warning.
 
-        casted = True
+        compiled = compile_schema(schema)
         if type(data) == dict:
-            for k,v in data.items():
-                if k in schema:
-                    if type(v) == list:
-                        casted_v = []
-                        uncasted_v = []
-                        for elem in v:
-                            if type(v) != schema[k]:
-                                try: 
-                                    caster = schema[k]
-                                    casted_v.append(caster(elem))
-                                except Exception as e:
-                                    casted_v.append(None)
-                                    uncasted_v.append(elem)
-                            else:
-                                casted_v.append(elem)
-
-                        data[k]= casted_v
-                        if len(uncasted_v):
-                            warnings.warn(f"Failed to cast {uncasted_v}")
-                            casted = False
-
-                    elif type(v) != schema[k]:
-                        try:
-                            caster = schema[k]
-                            data[k] = caster(v)
-                        except Exception as e:
-                            warnings.warn(f"Failed to cast data '{v}' from {type(v)} to {caster}: {e}")
-                            casted = False
-                else:
-                    warnings.warn(f'{k} not in schema')
-                    casted = False
+            casted = True
+            not_in_schema = [k for k in data.keys() if k not in schema]
+            if len(not_in_schema):
+                warnings.warn(f'{not_in_schema} not in schema')
+                casted = False
+
+            data, failed = compiled.cast_dict(data)
+            if len(failed):
+                warnings.warn(f"Failed to cast {failed}")
+                casted = False
             return data, casted
         
         elif type(data) == pl.dataframe.frame.DataFrame:
-            data = pl.DataFrame(data)
-            for column, expected_dtype in schema.items():
-                if column in data.columns:
-                    actual_dtype = data[column].dtype
-                    if actual_dtype != expected_dtype:
-                        try:
-                            data = data.with_columns(data[column].cast(expected_dtype))
-                        except Exception as e:
-                            warnings.warn(f"Failed to cast column '{column}' from {actual_dtype} to {expected_dtype}: {e}")
-                            casted = False
-            
-            return data, casted
+            data, failed = compiled.cast_frame(data)
+            if failed is not None:
+                failed_counts = {k:v for k,v in failed.sum().row(0, named = True).items() if v}
+                if len(failed_counts):
+                    warnings.warn(f"Failed to cast values in columns {failed_counts}")
+                    return data, False
+
+            return data, True
         else:
             warnings.warn('Only polars dataframe or dictionary can be used as input')
             return None, False
@@ -159,33 +593,427 @@ class CsvDatabase():
 
         return data, schema
 
-    def load_all(self):
-        for tbl in self.schema.keys():
-            self.load_table(tbl)
+    def load_all(self, workers = 4):
+
+        # Tables are independent, so their reads and schema normalization overlap on a thread pool
+
+        tables = list(self.schema.keys())
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers = workers) as pool:
+                return all(pool.map(self.load_table, tables))
+        else:
+            return all([self.load_table(tbl) for tbl in tables])
+
+    def preload(self, tables = None):
+
+        # Start loading tables in the background (e.g. while a user fills in a form). Returns dict of {table: Future}. 
+        # Anything that needs a table still being loaded waits for it to finish.
+
+        if tables is None:
+            tables = list(self.database.keys())
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers = 4)
+        return {tbl: self.executor.submit(self.load_table, tbl) for tbl in tables}
+
+    def _load_lock(self, tbl):
+        with self.locks_lock:
+            return self.load_locks.setdefault(tbl, threading.Lock())
     
-    def load_table(self, tbl):
+    @timed
+    def load_table(self, tbl, merge = True):
+
+        # Loads the table from file if it hasn't been yet. If merge, any buffered entries are merged into the table frame
+        # so self.database[tbl] is complete. Internal writers pass merge = False to keep appending to the buffer.
+        # Safe to call from several threads, a table is only read once.
 
         if tbl in self.database.keys():
+            if self.memory_budget is not None:
+                self.touch(tbl)
             if self.database[tbl] is None:
-                
-                data = pl.read_csv(self.reference[tbl])
-                schema = self.schema[tbl]
-                if schema:
-                    data, schema = self.normalize_data_by_schema(schema, data)
-                
-                try:
-                    self.database[tbl] = pl.DataFrame(data = data, schema = schema, strict = self.strict)
-                    self.schema[tbl] = schema
-                    return True
-                except Exception as e:
-                    warnings.warn(f'Error: {e.args[0]}, {tbl} not created')
-                    return False
+                with self._load_lock(tbl):
+                    if self.database[tbl] is None:
+                        if not self._read_table(tbl):
+                            return False
+                return True
             else:
+                if merge:
+                    self.flush(tbl)
                 return True
         else:
             warnings.warn(f'{tbl} not found in {self.init_dir}')
             return False
 
+    def _read_table(self, tbl):
+
+        # Files are read into memory once and hashed, so refresh() can tell real changes from touched files. 
+        # Memory-mapped storage is read from the path and not hashed
+        
+        start = time.perf_counter()
+        path = self.reference[tbl]
+        if self.storage.memory_mapped:
+            stamp = self.file_stamp(tbl)
+            data = self.storage.read(path)
+        else:
+            stamp = self.file_stamp(tbl)
+            with open(path, 'rb') as f:
+                raw = f.read()
+            stamp['hash'] = hashlib.blake2b(raw, digest_size = 16).hexdigest()
+            data = self.storage.read(io.BytesIO(raw))
+
+        schema = self.schema[tbl]
+        if schema:
+            data, schema = self.normalize_data_by_schema(schema, data)
+        
+        try:
+            data = pl.DataFrame(data = data, schema = schema, strict = self.strict)
+        except Exception as e:
+            warnings.warn(f'Error: {e.args[0]}, {tbl} not created')
+            return False
+
+        self.schema[tbl] = schema
+        self.key_templates.pop(tbl, None)
+        self.database[tbl] = data
+        self.replay_log(tbl)
+        self.versions[tbl] = self.versions.get(tbl, 0) + 1
+        self.saved_versions[tbl] = self.versions[tbl]
+        self.file_stamps[tbl] = stamp
+        if self.shared:
+            self.bases[tbl] = self.database[tbl]
+        if self.stats is not None:
+            self.stats['load_time'][tbl] = time.perf_counter() - start
+        return True
+
+    def touch(self, tbl):
+
+        # Mark a table as most recently used
+
+        with self.budget_lock:
+            self.recent[tbl] = None
+            self.recent.move_to_end(tbl)
+
+    def table_size(self, tbl):
+
+        # Estimated bytes a loaded table takes up in memory, including buffered entries. 0 if not loaded
+
+        data = self.database.get(tbl)
+        if data is None:
+            return 0
+        return data.estimated_size() + sum(p.estimated_size() for p in self.pending.get(tbl, []))
+
+    @contextmanager
+    def pinned(self, *tbls):
+
+        # Keep tables loaded while the block runs, for callers holding on to self.database frames across calls. Loading
+        # never unloads other tables, only saves and reads do (see enforce_budget).
+        # Pins nest, and the budget is enforced once the outermost block exits
+
+        with self.budget_lock:
+            for tbl in tbls:
+                self.pins[tbl] = self.pins.get(tbl, 0) + 1
+        try:
+            yield
+        finally:
+            with self.budget_lock:
+                for tbl in tbls:
+                    self.pins[tbl] -= 1
+                    if not self.pins[tbl]:
+                        del self.pins[tbl]
+                done = not self.pins
+            if done:
+                self.enforce_budget()
+
+    def enforce_budget(self, keep = None):
+
+        # Unload least recently used tables until loaded tables fit in memory_budget. Tables with unsaved changes, pinned
+        # tables, keep (the table about to be read) and tables being loaded by another thread stay loaded, and nothing is 
+        # unloaded during a transaction. Called at safe points rather than on load, so a table isn't unloaded while a caller
+        # is still using its frame: after saves, and at the start of get_entries and scan, which hand out frames of their own.
+        # Returns the unloaded tables
+
+        if (self.memory_budget is None) or (self.transaction_state is not None):
+            return []
+
+        unloaded = []
+        with self.budget_lock:
+            sizes = {tbl: self.table_size(tbl) for tbl in self.database.keys() if self.database[tbl] is not None}
+            total = sum(sizes.values())
+            for tbl in list(self.recent.keys()):
+                if total <= self.memory_budget:
+                    break
+                if (tbl == keep) or (tbl not in sizes.keys()) or self.pins.get(tbl) or self.is_dirty(tbl) or self.pending.get(tbl):
+                    continue
+                lock = self._load_lock(tbl)
+                if lock.acquire(blocking = False):
+                    try:
+                        self.unload_table(tbl)
+                    finally:
+                        lock.release()
+                    total -= sizes[tbl]
+                    del self.recent[tbl]
+                    unloaded.append(tbl)
+        return unloaded
+
+    def enable_stats(self):
+
+        # Opt-in instrumentation: from now on, table load times and the calls and durations of the main methods 
+        # (those decorated with timed) are recorded. Enabling again starts over. Read with get_stats
+
+        with self.stats_lock:
+            self.stats = {'methods': {}, 'load_time': {}}
+
+    def disable_stats(self):
+        self.stats = None
+
+    def record_timing(self, name, elapsed):
+        with self.stats_lock:
+            if self.stats is not None:
+                method = self.stats['methods'].setdefault(name, {'calls': 0, 'total': 0.0, 'samples': deque(maxlen = STATS_SAMPLES)})
+                method['calls'] += 1
+                method['total'] += elapsed
+                method['samples'].append(elapsed)
+
+    def get_stats(self, as_json = False):
+
+        # Snapshot of per-table rows, estimated size in memory (bytes, loaded tables including buffered entries) and load 
+        # time (s), and per-method calls, cumulative time and p50/p99 latency (ms, over the latest STATS_SAMPLES calls).
+        # Method stats are only kept while enabled. Returned as a dict, or a JSON string if as_json
+
+        with self.stats_lock:
+            stats = self.stats
+            methods = {} if stats is None else {name: (m['calls'], m['total'], sorted(m['samples'])) for name, m in stats['methods'].items()}
+            load_time = {} if stats is None else dict(stats['load_time'])
+
+        tables = {}
+        for tbl, data in list(self.database.items()):
+            tables[tbl] = {'loaded': data is not None, 'rows': None, 'estimated_size': None, 'load_time': load_time.get(tbl)}
+            if data is not None:
+                tables[tbl]['rows'] = len(data) + sum(len(p) for p in self.pending.get(tbl, []))
+                tables[tbl]['estimated_size'] = self.table_size(tbl)
+
+        report = {
+            'tables': tables,
+            'methods': {name: {'calls': calls, 'total_ms': total * 1000, 'p50_ms': percentile(samples, 0.5) * 1000, 'p99_ms': percentile(samples, 0.99) * 1000}
+                        for name, (calls, total, samples) in methods.items()}
+        }
+        if as_json:
+            return json.dumps(report, indent = 1)
+        else:
+            return report
+
+    def file_stamp(self, tbl):
+
+        # Modification time and size of a table's file and change log. Hash is filled in when the file is read
+
+        stamp = {'mtime': None, 'size': None, 'hash': None, 'log': None}
+        if os.path.exists(self.reference[tbl]):
+            stat = os.stat(self.reference[tbl])
+            stamp['mtime'] = stat.st_mtime_ns
+            stamp['size'] = stat.st_size
+        if os.path.exists(self.log_path(tbl)):
+            stat = os.stat(self.log_path(tbl))
+            stamp['log'] = (stat.st_mtime_ns, stat.st_size)
+        return stamp
+
+    def file_changed(self, tbl):
+
+        # True if the table's file or change log changed on disk since it was loaded or saved. Only files whose
+        # modification time or size changed are hashed.
+
+        old = self.file_stamps.get(tbl)
+        if old is None:
+            return False
+
+        new = self.file_stamp(tbl)
+        if new['log'] != old['log']:
+            return True
+        if (new['mtime'] == old['mtime']) and (new['size'] == old['size']):
+            return False
+        if (old['hash'] is None) or (new['size'] != old['size']) or (new['mtime'] is None):
+            return True
+
+        with open(self.reference[tbl], 'rb') as f:
+            changed = hashlib.blake2b(f.read(), digest_size = 16).hexdigest() != old['hash']
+        if not changed:
+            # touched but identical, don't hash again next time
+            new['hash'] = old['hash']
+            self.file_stamps[tbl] = new
+        return changed
+
+    def unload_table(self, tbl):
+
+        # Return a loaded table to its unloaded state (None). Buffered entries and indexes are dropped, 
+        # so callers check is_dirty first
+
+        if tbl in self.database.keys():
+            self.database[tbl] = None
+            self.pending[tbl] = []
+            self.pending_rows[tbl] = 0
+            self.invalidate_index(tbl)
+            self.changes[tbl] = []
+            self.file_stamps.pop(tbl, None)
+            self.bases.pop(tbl, None)
+
+    def refresh(self):
+
+        # Reload loaded tables whose files were changed by another process. Tables with unsaved changes are not
+        # reloaded. Tables scanned from file in lazy mode aren't loaded, their versions are bumped so results built 
+        # from them (e.g. searchingAPI's index and result cache) are rebuilt from the new file.
+        # Cheap enough (a stat per table) for a GUI to poll. Returns the reloaded tables
+
+        reloaded = []
+        for tbl in list(self.database.keys()):
+            if (self.database[tbl] is None) and self.file_changed(tbl):
+                self.file_stamps[tbl] = self.file_stamp(tbl)
+                self.versions[tbl] = self.versions.get(tbl, 0) + 1
+                self.saved_versions[tbl] = self.versions[tbl]
+                reloaded.append(tbl)
+            elif (self.database[tbl] is not None) and self.file_changed(tbl):
+                if self.is_dirty(tbl):
+                    warnings.warn(f'{tbl} changed on disk but has unsaved changes, not reloaded')
+                else:
+                    self.unload_table(tbl)
+                    if self.load_table(tbl):
+                        reloaded.append(tbl)
+        return reloaded
+
+    @timed
+    def scan(self, tbl):
+
+        # LazyFrame of a table for composing queries. Loaded tables are wrapped as they are. In lazy mode tables that
+        # haven't been loaded are scanned from file with the schema applied, so polars can push predicates and 
+        # column selection into the read. Callers collect() once at the end of the query.
+
+        if tbl not in self.database.keys():
+            warnings.warn(f'{tbl} not found in {self.init_dir}')
+            return None
+        if self.memory_budget is not None:
+            self.enforce_budget(keep = tbl)
+
+        if (self.database[tbl] is None) and self.lazy and (not os.path.exists(self.log_path(tbl))):
+            # stamped so refresh() notices when the file changes
+            if tbl not in self.file_stamps.keys():
+                self.file_stamps[tbl] = self.file_stamp(tbl)
+            frame = self.storage.scan(self.reference[tbl])
+            schema = self.schema[tbl]
+            if schema:
+                columns = frame.collect_schema()
+                frame = frame.select(compile_schema(schema).scan_exprs(columns, keep_extra = self.expand_fields))
+            return frame
+        elif self.load_table(tbl):
+            return self.database[tbl].lazy()
+        else:
+            return None
+
+    @timed
+    def flush(self, tbl):
+
+        # Merge buffered entries into the main table frame in a single concat. Concatenated frames are chunked, and filters
+        # slow down with every chunk, so the frame is made contiguous again once it has MAX_CHUNKS
+
+        if self.pending.get(tbl):
+            self.database[tbl] = pl.concat([self.database[tbl]] + self.pending[tbl], how = 'diagonal_relaxed')
+            if self.database[tbl].n_chunks() > MAX_CHUNKS:
+                self.database[tbl] = self.database[tbl].rechunk()
+            self.pending[tbl] = []
+            self.pending_rows[tbl] = 0
+
+    def buffered(self, tbl):
+
+        # Buffered entries of a table as one frame with the table's columns, or None if there are none. The buffer is
+        # collapsed in place so lookups between writes check one small frame rather than merging it into the table.
+        # Buffered entries adding fields are merged instead, so the table has every field a key can use
+
+        if not self.pending.get(tbl):
+            return None
+        schema = self.database[tbl].schema
+        if all(p.schema == schema for p in self.pending[tbl]):
+            if len(self.pending[tbl]) > 1:
+                self.pending[tbl] = [pl.concat(self.pending[tbl], rechunk = True)]
+            return self.pending[tbl][0]
+        data = pl.concat([self.database[tbl].clear()] + self.pending[tbl], how = 'diagonal_relaxed').rechunk()
+        if len(data.columns) > len(schema):
+            self.flush(tbl)
+            return None
+        self.pending[tbl] = [data]
+        return data
+
+    @contextmanager
+    def transaction(self):
+
+        # Apply a group of mutations together or not at all, e.g.
+        #   with db.transaction():
+        #       db.write_entry('studies', ...)
+        #       db.write_entries('study_methods', ...)
+        # Inserts stay buffered until the block ends, then tables over buffer_size are merged with one concat each. If the block raises, 
+        # every table it touched is restored to its state at the start and the exception is re-raised. 
+        # Nested transactions join the outer one. Tables saved inside the block are not restored on disk
+
+        if self.transaction_state is not None:
+            yield self
+            return
+
+        self.transaction_state = {
+            'database': dict(self.database),
+            'reference': dict(self.reference),
+            'schema': {k: dict(v) for k, v in self.schema.items()},
+            'pending': {k: list(v) for k, v in self.pending.items()},
+            'pending_rows': dict(self.pending_rows),
+            'changes': {k: (None if v is None else list(v)) for k, v in self.changes.items()},
+            'versions': dict(self.versions),
+        }
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        else:
+            self.transaction_state = None
+            for tbl in self.database.keys():
+                if self.pending_rows.get(tbl, 0) >= self.buffer_size:
+                    self.flush(tbl)
+
+    def rollback(self):
+
+        # Restore tables changed since the current transaction started (see transaction)
+
+        state = self.transaction_state
+        self.transaction_state = None
+        if state is None:
+            return False
+
+        for tbl in list(self.database.keys()):
+            if tbl not in state['database'].keys():
+                # created in the transaction
+                for d in [self.database, self.reference, self.schema, self.pending, self.pending_rows, self.changes, self.bases, 
+                          self.versions, self.saved_versions, self.file_stamps]:
+                    d.pop(tbl, None)
+                self.indexes.pop(tbl, None)
+            elif self.versions.get(tbl, 0) != state['versions'].get(tbl, 0):
+                if state['database'][tbl] is None:
+                    # loaded in the transaction
+                    self.unload_table(tbl)
+                    self.versions[tbl] = self.saved_versions.get(tbl, 0)
+                else:
+                    self.database[tbl] = state['database'][tbl]
+                    self.pending[tbl] = state['pending'].get(tbl, [])
+                    self.pending_rows[tbl] = state['pending_rows'].get(tbl, 0)
+                    self.changes[tbl] = state['changes'].get(tbl, [])
+                    self.versions[tbl] = state['versions'].get(tbl, 0)
+                    self.invalidate_index(tbl)
+                if tbl in state['schema'].keys():
+                    self.schema[tbl] = state['schema'][tbl]
+                    self.key_templates.pop(tbl, None)
+        return True
+
+    def count_entries(self, tbl):
+
+        # Number of rows in a table including buffered entries, without merging them
+
+        if self.load_table(tbl, merge = False):
+            return len(self.database[tbl]) + self.pending_rows.get(tbl, 0)
+        else:
+            return 0
+
     def get_tables(self):
         return list(self.database.keys())
     
@@ -197,29 +1025,153 @@ class CsvDatabase():
         else:
             return False
 
+    def add_index(self, tbl, cols):
+
+        # Declare a hash index on one or more key columns of a table. The index maps the tuple of key values to the
+        # row positions holding them and is built the first time a lookup needs it.
+
+        if type(cols) == str:
+            cols = (cols,)
+        else:
+            cols = tuple(cols)
+
+        if cols not in self.index_cols.setdefault(tbl, []):
+            self.index_cols[tbl].append(cols)
+        self.indexes.setdefault(tbl, {})[cols] = None
+
+    def build_index(self, tbl, cols):
+        
+        self.flush(tbl)
+        grouped = self.database[tbl].select(cols).with_row_index('__row').group_by(cols, maintain_order = True).agg(pl.col('__row'))
+        index = {row[:-1]: row[-1] for row in grouped.iter_rows()}
+        self.indexes[tbl][cols] = index
+        return index
+
+    def invalidate_index(self, tbl, cols = None):
+
+        # Drop built indexes so they are rebuilt on next lookup. If cols is given, only indexes using one of those columns are dropped
+
+        for index_cols in self.indexes.get(tbl, {}).keys():
+            if (cols is None) or any(c in index_cols for c in cols):
+                self.indexes[tbl][index_cols] = None
+
+    def _index_insert(self, tbl, data, row):
+
+        # Add a newly appended row to every built index on tbl
+
+        for cols, index in self.indexes.get(tbl, {}).items():
+            if index is not None:
+                index.setdefault(tuple(data.get(c) for c in cols), []).append(row)
+
+    def _index_delete(self, tbl, rows):
+
+        # Remove deleted row positions (sorted) from every built index on tbl, shifting the positions after them down
+        # by the number of deleted rows before them. Positions in an index entry are sorted, so entries ending before
+        # the first deleted row are left as they are
+
+        if not rows:
+            return
+        first = rows[0]
+        gone = set(rows)
+        for cols, index in self.indexes.get(tbl, {}).items():
+            if index is not None:
+                for value in list(index.keys()):
+                    positions = index[value]
+                    if positions[-1] < first:
+                        continue
+                    kept = [r - bisect_left(rows, r) for r in positions if r not in gone]
+                    if kept:
+                        index[value] = kept
+                    else:
+                        del index[value]
+
+    def _index_lookup(self, tbl, key):
+
+        # Returns row positions matching key using the widest declared index covered by the scalar values in key,
+        # along with the part of the key the index doesn't cover. Rows are None if no index applies.
+
+        scalars = [k for k,v in key.items() if (type(v) != list) and (v is not None)]
+        fields = self.get_fields(tbl)
+        best = None
+        for cols in self.index_cols.get(tbl, []):
+            if all((c in scalars) and (c in fields) for c in cols):
+                if (best is None) or (len(cols) > len(best)):
+                    best = cols
+
+        if best is None:
+            return None, key
+        
+        index = self.indexes[tbl][best]
+        if index is None:
+            index = self.build_index(tbl, best)
+
+        rows = index.get(tuple(key[c] for c in best), [])
+        rest = {k:v for k,v in key.items() if k not in best}
+        return rows, rest
+
+    def key_template(self, tbl, key):
+
+        # Keys are compiled once per shape (their columns, and list or scalar values) into the columns to compare and 
+        # the columns not in the table, so lookups in a loop don't re-check the table's fields. Cleared when fields change
+
+        shape = tuple((col, type(val) == list) for col, val in key.items())
+        templates = self.key_templates.setdefault(tbl, {})
+        template = templates.get(shape)
+        if template is None:
+            fields = set(self.get_fields(tbl))
+            template = ([(col, pl.col(col), is_list) for col, is_list in shape if col in fields], [col for col, _ in shape if col not in fields])
+            templates[shape] = template
+        return template
+
+    def key_filter(self, tbl, key):
+
+        # Filter expression for a key dict, binding the key's values to its compiled template. Returns the expression
+        # and the key columns not in the table (left out of the expression)
+
+        terms, missing = self.key_template(tbl, key)
+        exprs = [expr.is_in(key[col]) if is_list else (expr == key[col]) for col, expr, is_list in terms]
+        if len(exprs) == 0:
+            return pl.lit(True), missing
+        elif len(exprs) == 1:
+            return exprs[0], missing
+        else:
+            return pl.all_horizontal(exprs), missing
+
+    @timed
     def get_entries(self, tbl, key, null_search = False, as_dict = False):
         
+        if self.memory_budget is not None:
+            self.enforce_budget(keep = tbl)
         key, casted = self.match_schema(key, self.schema[tbl])
 
         if not casted:
             warnings.warn("Key doesn't match table schema. Try again")
             return False, None
+
+        if type(key) == pl.dataframe.frame.DataFrame:
+            key = key.to_dict(as_series = False)
+
+        return self.find_entries(tbl, key, as_dict = as_dict)
+
+    def find_entries(self, tbl, key, as_dict = False):
+
+        # get_entries for a key already cast to the table schema
+
+        # In lazy mode, tables that haven't been loaded are filtered while scanning rather than loaded
+        scanning = self.lazy and (tbl in self.database.keys()) and (self.database[tbl] is None) and (not os.path.exists(self.log_path(tbl)))
         
-        if self.load_table(tbl):
+        if scanning or self.load_table(tbl, merge = False):
             
-            if type(key) == pl.dataframe.frame.DataFrame:
-                key = key.to_dict(as_series = False)
-
-            if type(key) == dict:
-                filter_expr = pl.lit(True)
-                for col, val in key.items():
-                    if col in self.get_fields(tbl):
-                        if type(val) == list:
-                            filter_expr &= (pl.col(col).is_in(val))
-                        else:
-                            filter_expr &= (pl.col(col) == val)
-                    else:
-                        warnings.warn(f'{col} not found in {tbl}')
+            # Buffered entries are checked separately rather than merged into the table on every lookup
+            rows = None
+            buffered = None
+            if not scanning:
+                rows, key = self._index_lookup(tbl, key)
+                buffered = self.buffered(tbl)
+
+            filter_expr, missing = self.key_filter(tbl, key)
+            for col in missing:
+                warnings.warn(f'{col} not found in {tbl}')
 
 
             # elif type(key) == pl.dataframe.frame.DataFrame:
@@ -228,16 +1180,27 @@ class CsvDatabase():
             #     filter_expr = [self.database[tbl][col] == value for col, value in filter_conditions]
             #     filter_expr = pl.all(filter_expr)
 
+            if scanning:
+                entries = self.scan(tbl).filter(filter_expr).collect()
+            elif rows is None:
+                entries = self.database[tbl].filter(filter_expr)
+                if buffered is not None:
+                    matches = buffered.filter(filter_expr)
+                    if len(matches):
+                        entries = pl.concat([entries, matches], how = 'diagonal_relaxed')
+            else:
+                # index positions past the end of the table point into the buffer
+                n = len(self.database[tbl])
+                entries = self.database[tbl][[r for r in rows if r < n]]
+                if (buffered is not None) and any(r >= n for r in rows):
+                    entries = pl.concat([entries, buffered[[r - n for r in rows if r >= n]]], how = 'diagonal_relaxed')
+                if len(key):
+                    entries = entries.filter(filter_expr)
+
             if not as_dict:
-                return True, self.database[tbl].filter(filter_expr)
+                return True, entries
             else:
-                entries = self.database[tbl].filter(filter_expr)
-                if len(entries) > 1:
-                    return True, entries.to_dict(as_series = False)
-                elif len(entries) == 1:
-                    return True, {k:v[0] for k,v in entries.to_dict(as_series = False).items()}
-                else:
-                    return True, {k:None for k in entries.columns}
+                return True, entries_as_dict(entries)
 
         else:
             return False, None
@@ -247,7 +1210,7 @@ class CsvDatabase():
         if tbl in self.database.keys():
             warnings.warn(f"{tbl} already exists in database - nothing new created")
         else:
-            tbl_fn = tbl+'.csv'
+            tbl_fn = tbl + self.storage.ext
             
             if schema and data:
                 data, schema = self.normalize_data_by_schema(schema, data)
@@ -261,11 +1224,14 @@ class CsvDatabase():
                 if schema is None:
                     schema = pl.Schema(self.database[tbl].schema).to_python()
                 self.schema[tbl] = schema
+                self.key_templates.pop(tbl, None)
+                self.record_change(tbl, None)
                 return True
             except Exception as e:
                 print(f'Error: {e.args[0]}, {tbl} not created')
                 return False
              
+    @timed
     def _create_entry(self, tbl, data): 
 
         # Private function to add a new entry to a table. Write entry has more functionality to check for 
@@ -277,12 +1243,23 @@ class CsvDatabase():
                 data, schema = self.normalize_data_by_schema(schema, data)
 
             try:
-                self.database[tbl] = pl.concat((self.database[tbl], pl.DataFrame(data = data, schema = schema, strict = self.strict)))
-                self.schema[tbl] = schema
-                return True
+                entry = pl.DataFrame(data = data, schema = schema, strict = self.strict)
             except Exception as e:
                 print(f'Error: {e.args[0]}, entry not added')
                 return False
+
+            # Entries are buffered and merged into the table frame in bulk
+            row = self.count_entries(tbl)
+            self.record_change(tbl, {'op': 'insert', 'rows': [dict(data)]})
+            self.pending.setdefault(tbl, []).append(entry)
+            self.pending_rows[tbl] = self.pending_rows.get(tbl, 0) + len(entry)
+            self.schema[tbl] = schema
+            if self.expand_fields:
+                self.key_templates.pop(tbl, None)
+            self._index_insert(tbl, data, row)
+            if (self.pending_rows[tbl] >= self.buffer_size) and (self.transaction_state is None):
+                self.flush(tbl)
+            return True
         else:
             print('Will not add an empty row')
             return False
@@ -292,13 +1269,13 @@ class CsvDatabase():
         # Add data to a table. Key allows for checking for entry that might already
         # exist in table with keys. Returns boolean to indicate if entry was created
         
-        if self.load_table(tbl):
+        if self.load_table(tbl, merge = False):
             if key is None:
                 return self._create_entry(tbl, data)
             else:
                 key, casted = self.match_schema(key, self.schema[tbl])
                 if casted:
-                    matched, matches = self.get_entries(tbl, key)
+                    matched, matches = self.find_entries(tbl, key)
                     # rows, _  = self.get_entries(tbl, key).shape # look to see if 
                     if (not matched) or matches.shape[0]== 0:
                         return self._create_entry(tbl, data)
@@ -317,6 +1294,97 @@ class CsvDatabase():
             warnings.warn(f'{tbl} not in database')
             return False
 
+    @timed
+    def write_entries(self, tbl, data, key_cols = None, overwrite = False):
+
+        # Bulk version of write_entry. Data is a list of dicts or a polars dataframe. Rows are normalized to the schema
+        # once and key conflicts are resolved with a single join on key_cols: conflicting rows are skipped, or replace 
+        # the existing entries if overwrite. Remaining rows are appended in one concat. Returns number of rows written
+
+        if not self.load_table(tbl, merge = False):
+            warnings.warn(f'{tbl} not in database')
+            return 0
+
+        data = self.prepare_entries(tbl, data)
+        if data is None:
+            return 0
+
+        if key_cols:
+            if type(key_cols) == str:
+                key_cols = [key_cols]
+            index_cols = [cols for cols in self.index_cols.get(tbl, []) if set(cols) == set(key_cols)]
+
+            if overwrite:
+                data = data.unique(subset = key_cols, keep = 'last', maintain_order = True)
+                self._delete_keys(tbl, data.select(key_cols))
+            elif len(index_cols):
+                # an index on the key columns answers conflicts without merging the buffer
+                data = data.unique(subset = key_cols, keep = 'first', maintain_order = True)
+                index = self.indexes[tbl][index_cols[0]]
+                if index is None:
+                    index = self.build_index(tbl, index_cols[0])
+                new = [k not in index for k in data.select(index_cols[0]).iter_rows()]
+                data = data.filter(pl.Series(new, dtype = pl.Boolean))
+            else:
+                data = data.unique(subset = key_cols, keep = 'first', maintain_order = True)
+                data = data.join(self.database[tbl].select(key_cols), on = key_cols, how = 'anti')
+                buffered = self.buffered(tbl)
+                if buffered is not None:
+                    data = data.join(buffered.select(key_cols), on = key_cols, how = 'anti')
+
+        if len(data):
+            row = self.count_entries(tbl)
+            self.record_change(tbl, {'op': 'insert', 'rows': data.to_dicts()})
+            self.pending.setdefault(tbl, []).append(data.select(self.database[tbl].columns))
+            self.pending_rows[tbl] = self.pending_rows.get(tbl, 0) + len(data)
+
+            if any(index is not None for index in self.indexes.get(tbl, {}).values()):
+                for i, entry in enumerate(data.iter_rows(named = True)):
+                    self._index_insert(tbl, entry, row + i)
+
+            if (self.pending_rows[tbl] >= self.buffer_size) and (self.transaction_state is None):
+                self.flush(tbl)
+
+        return len(data)
+
+    def prepare_entries(self, tbl, data):
+
+        # Rows for write_entries as a dataframe normalized to the table schema, without empty rows. None if they can't be
+
+        if type(data) == list:
+            data = [d for d in data if not all(v is None for v in d.values())]
+            if not len(data):
+                return None
+            data = pl.DataFrame(data, infer_schema_length = None, strict = False)
+        elif type(data) != pl.dataframe.frame.DataFrame:
+            warnings.warn('Only polars dataframe or list of dictionaries can be written')
+            return None
+
+        schema = self.schema[tbl]
+        if schema:
+            data, schema = self.normalize_data_by_schema(schema, data)
+            data, casted = self.match_schema(data, schema)
+            if not casted:
+                return None
+            self.schema[tbl] = schema
+            if self.expand_fields:
+                self.key_templates.pop(tbl, None)
+
+        data = data.filter(~pl.all_horizontal(pl.all().is_null()))
+        return data
+
+    def _delete_keys(self, tbl, keys):
+
+        # Delete all entries whose key columns match a row of the keys dataframe, found with a single semi join
+
+        self.flush(tbl)
+        rows = self.database[tbl].select(keys.columns).with_row_index('__row').join(keys, on = keys.columns, how = 'semi')
+        if len(rows):
+            rows = rows['__row'].sort()
+            self.record_change(tbl, {'op': 'delete_keys', 'keys': keys.to_dict(as_series = False)})
+            self.database[tbl] = self.database[tbl].with_row_index('__row').filter(~pl.col('__row').is_in(rows)).drop('__row')
+            self._index_delete(tbl, rows.to_list())
+
     def update_field(self, tbl, key, data):
         # Used to update a single column/field of the entry - data is a tuple
         # Note all entries that match the key will be updated
@@ -327,49 +1395,82 @@ class CsvDatabase():
             warnings.warn(f'Update field is used to change a single column, data should be a two element tuple')
             return False
         
+        return self.update_fields(tbl, key, {data[0]: data[1]})
+
+    @timed
+    def update_fields(self, tbl, key, data):
+        # Update several columns/fields of all entries matching key - data is a dict of {column: new value}
+        # All columns are replaced in a single pass over the table
+
         key, casted = self.match_schema(key, self.schema[tbl])
         if casted:
             if self.load_table(tbl):
-                if data[0] in self.get_fields(tbl):
-
-                    if type(data[1]) != self.schema[tbl][data[0]]:
-                        try:
-                            caster =  self.schema[tbl][data[0]]
-                            replace = caster(data[1])
-                        except:
-                            warnings.warn(f'Datatype does not match {self.schema[tbl][data[0]]}')
-                            return False
-                    else:
-                        replace = data[1]
-
 
-                    filter_expr = pl.lit(True)
-                    for col, val in key.items():
-                        if col in self.get_fields(tbl):
-                            if type(val) == list:
-                                filter_expr &= (pl.col(col).is_in(val))
-                            else:
-                                filter_expr &= (pl.col(col) == val)
-                        else:
-                            warnings.warn(f'{col} not found in {tbl}')
-                            return False
-                            
-                    indices = self.database[tbl].select(pl.arg_where(filter_expr))['literal'].to_list()
-                    if len(indices):
-                        for i in indices:
-                            self.database[tbl][i, data[0]] = replace
-                        return True
-                    else:
-                        warnings.warn(f'No matching entry, refine key')
+                fields = self.get_fields(tbl)
+                for col in data.keys():
+                    if col not in fields:
+                        warnings.warn(f'Column: {col} not found in {tbl}')
                         return False
+
+                replace, failed = compile_schema(self.schema[tbl]).cast_dict(dict(data))
+                if len(failed):
+                    warnings.warn(f'Datatype does not match {[self.schema[tbl][col] for col in failed.keys()]}')
+                    return False
+
+                filter_expr, missing = self.key_filter(tbl, key)
+                if len(missing):
+                    warnings.warn(f'{missing[0]} not found in {tbl}')
+                    return False
+
+                if len(key):
+                    matched = self.database[tbl].select(filter_expr.sum()).item()
                 else:
-                    warnings.warn(f'Column: {data[0]} not found in {tbl}')
+                    matched = len(self.database[tbl])
+
+                if matched:
+                    tbl_schema = self.database[tbl].schema
+                    self.database[tbl] = self.database[tbl].with_columns([
+                        pl.when(filter_expr).then(pl.lit(val, dtype = tbl_schema[col])).otherwise(pl.col(col)).alias(col) 
+                        for col, val in replace.items()
+                    ])
+                    self.invalidate_index(tbl, list(replace.keys()))
+                    self.record_change(tbl, {'op': 'update', 'key': key, 'data': replace})
+                    return True
+                else:
+                    warnings.warn(f'No matching entry, refine key')
                     return False
             else:
                 return False
         else:
             return False
                
+    def fill_field(self, tbl, field, key_col, values):
+
+        # Fill the nulls of field from values, a dict of {key_col value: field value}, in one pass over the table. Rows
+        # already holding a value, and rows whose key_col isn't in values, are left as they are. Logged as an update 
+        # per key filled. Returns the number of rows filled
+
+        if (not len(values)) or (not self.load_table(tbl)):
+            return 0
+
+        data = self.database[tbl]
+        if (field not in data.columns) or (key_col not in data.columns):
+            warnings.warn(f'{field} or {key_col} not found in {tbl}')
+            return 0
+
+        fill = pl.col(field).is_null() & pl.col(key_col).is_in(list(values.keys()))
+        filled = data.filter(fill)[key_col].unique(maintain_order = True).to_list()
+        if not len(filled):
+            return 0
+
+        count = data.select(fill.sum()).item()
+        mapped = pl.col(key_col).replace_strict(values, default = None, return_dtype = data.schema[field])
+        self.database[tbl] = data.with_columns(pl.when(fill).then(mapped).otherwise(pl.col(field)).alias(field))
+        self.invalidate_index(tbl, [field])
+        for k in filled:
+            self.record_change(tbl, {'op': 'update', 'key': {key_col: k}, 'data': {field: values[k]}})
+        return count
+
     def update_entry(self, tbl, key, data):
         # if you have a dictionary of data and only want to update columns that differ 
         # - should only be used for one to one relationship entries
@@ -384,11 +1485,13 @@ class CsvDatabase():
                 for k in data.keys():
                     if k in db_entry.keys():
                         if db_entry[k] != data[k]:
-                            self.update_field(tbl, key, (k, data[k]))
                             updates[k] = (db_entry[k], data[k])
                     else:
                         print(f'{k} not in {tbl}')
 
+                if len(updates):
+                    self.update_fields(tbl, key, {k: v[1] for k,v in updates.items()})
+
             return updates
     
     def add_field(self, tbl, schema = None, data= None):
@@ -401,6 +1504,7 @@ class CsvDatabase():
                 if (type(scheme) == type) or (type(scheme) == pl.datatypes.classes.DataTypeClass):
                     self.database[tbl] = self.database[tbl].with_columns([pl.lit(None).cast(scheme).alias(name)])
                     self.schema[tbl].update({name:scheme})
+                    self.record_change(tbl, None)
                 else:
                     warnings.warn('Schema must have a valid datatype (python or polars)')
                     return False
@@ -425,6 +1529,7 @@ class CsvDatabase():
                         return False
                 else:
                     self.schema[tbl].update({name: self.database[tbl].schema[name].to_python()}) 
+                self.record_change(tbl, None)
                 
             return True
         else:
@@ -434,111 +1539,752 @@ class CsvDatabase():
         if self.load_table(tbl):
             if field in self.get_fields(tbl):
                 self.database[tbl] = self.database[tbl].drop(pl.col(field))
+                self.invalidate_index(tbl, [field])
+                self.record_change(tbl, None)
             else:
                 warnings.warn(f'{field} not in {tbl}')
         else:
             return False
 
+    @timed
     def delete_entries(self, tbl, key):
 
         if self.load_table(tbl):
-            filter_expr = pl.lit(True)
-            for col, val in key.items():
-                if col in self.get_fields(tbl):
-                    if type(val) == list:
-                        filter_expr &= (pl.col(col).is_in(val))
-                    else:
-                        filter_expr &= (pl.col(col) == val)
-                else:
-                    print(f'{col} not found in {tbl}')
-
-            deleted = self.database[tbl].filter(filter_expr)
-            self.database[tbl] = self.database[tbl].filter(~filter_expr)
+            filter_expr, missing = self.key_filter(tbl, key)
+            for col in missing:
+                print(f'{col} not found in {tbl}')
+
+            mask = match_mask(self.database[tbl], filter_expr)
+            deleted = self.database[tbl].filter(mask)
+            if len(deleted):
+                self.database[tbl] = self.database[tbl].filter(~mask)
+                self._index_delete(tbl, mask.arg_true().to_list())
+                self.record_change(tbl, {'op': 'delete', 'key': key})
             return deleted
         else:
             print(f'{tbl} not found in {self.init_dir}')
             return None
     
+    def log_path(self, tbl):
+        return self.reference[tbl] + '.log'
+
+    def record_change(self, tbl, change):
+
+        # Called by every mutator. Bumps the table's version, which marks it dirty until saved. With write_log, the change
+        # is also kept to be appended to the table's change log on save. A change of None (e.g. adding or dropping a column) 
+        # can't be logged, so the next save rewrites the whole table instead
+
+        if tbl in self.replaying:
+            return
+        
+        self.versions[tbl] = self.versions.get(tbl, 0) + 1
+        if change is None:
+            self.key_templates.pop(tbl, None)
+        if self.write_log:
+            if change is None:
+                self.changes[tbl] = None
+            elif self.changes.setdefault(tbl, []) is not None:
+                self.changes[tbl].append(change)
+
+    def replay_log(self, tbl):
+
+        # Apply a table's change log on top of the freshly loaded table file. The table is marked as replaying so its
+        # changes aren't recorded again. Tables load on several threads (preload), so this is tracked per table
+
+        log_fn = self.log_path(tbl)
+        if not os.path.exists(log_fn):
+            return
+
+        self.replaying.add(tbl)
+        try:
+            with open(log_fn) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    change = json.loads(line, object_hook = decode_log_value)
+                    if change['op'] == 'insert':
+                        self.write_entries(tbl, change['rows'])
+                    elif change['op'] == 'update':
+                        self.update_fields(tbl, change['key'], change['data'])
+                    elif change['op'] == 'delete':
+                        self.delete_entries(tbl, change['key'])
+                    elif change['op'] == 'delete_keys':
+                        keys = pl.DataFrame(change['keys'], schema = {k: self.database[tbl].schema[k] for k in change['keys'].keys()})
+                        self._delete_keys(tbl, keys)
+            self.flush(tbl)
+        finally:
+            self.replaying.discard(tbl)
+
+    def is_dirty(self, tbl):
+        return self.versions.get(tbl, 0) != self.saved_versions.get(tbl, 0)
+
+    def get_dirty_tables(self):
+        return [tbl for tbl in self.database.keys() if (self.database[tbl] is not None) and self.is_dirty(tbl)]
+
+    def _write_table(self, tbl):
+
+        # Write to a temporary file next to the target and rename it over the target, so a crash mid-write 
+        # never leaves a partly written table
+
+        path = self.reference[tbl]
+        tmp_path = path + '.tmp'
+        try:
+            self.storage.write(self.database[tbl], tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def table_lock(self, tbl):
+        if self.shared:
+            return FileLock(self.reference[tbl] + '.lock')
+        else:
+            return nullcontext()
+
+    def merge_from_disk(self, tbl):
+
+        # Optimistic concurrency: called while holding the table lock when the file's stamp no longer matches the one 
+        # recorded at load, i.e. another process saved the table. Three-way merge against the table as it was loaded or
+        # last saved here (self.bases): entries added and removed here since (an update is both) are applied on top of 
+        # the table on disk, so changes others saved are kept. Entries whose key (the table's first index) was changed 
+        # both here and by the other process conflict, and the changes made here are kept with a warning. Without an index
+        # entries can't be matched by key: entries changed here that the other process also changed or deleted are 
+        # counted as conflicts, and both versions are kept with a warning. Returns the number of entries changed by others that were merged
+
+        disk = CsvDatabase(self.init_dir, schema = {tbl: dict(self.schema[tbl])}, storage = self.storage)
+        if (tbl not in disk.database.keys()) or (not disk.load_table(tbl)):
+            return 0
+
+        self.flush(tbl)
+        ours = self.database[tbl]
+        cols = ours.columns
+        align = lambda frame: pl.concat((ours.clear(), frame), how = 'diagonal_relaxed').select(cols)
+        base = align(self.bases[tbl]) if self.bases.get(tbl) is not None else ours.clear()
+        theirs = align(disk.database[tbl])
+
+        added = ours.join(base, on = cols, how = 'anti', nulls_equal = True)
+        removed = base.join(ours, on = cols, how = 'anti', nulls_equal = True)
+        changed = theirs.join(base, on = cols, how = 'anti', nulls_equal = True)
+        merged = theirs.join(removed, on = cols, how = 'anti', nulls_equal = True)
+
+        key = self.index_cols.get(tbl)
+        if key and len(changed) and (len(added) or len(removed)):
+            key = list(key[0])
+            conflicts = changed.join(pl.concat((added.select(key), removed.select(key))), on = key, how = 'semi', nulls_equal = True)
+            if len(conflicts):
+                warnings.warn(f'{len(conflicts)} entries in {tbl} were also changed by another user, keeping the changes made here')
+                merged = merged.join(conflicts, on = cols, how = 'anti', nulls_equal = True)
+                changed = changed.join(conflicts, on = cols, how = 'anti', nulls_equal = True)
+        elif len(changed) and len(removed):
+            conflicts = removed.join(theirs, on = cols, how = 'anti', nulls_equal = True)
+            if len(conflicts):
+                warnings.warn(f'{len(conflicts)} entries in {tbl} were also changed by another user and {tbl} has no index to match '
+                              'them by, keeping both versions')
+
+        added = added.join(merged, on = cols, how = 'anti', nulls_equal = True)
+        self.database[tbl] = pl.concat((merged, added), how = 'vertical_relaxed')
+        self.invalidate_index(tbl)
+        return len(changed)
+
+    @timed
     def save_tbl(self, tbl):
+
+        # Only dirty tables are written. With write_log, changes since the last save are appended to the change log 
+        # (O(changes)). Otherwise, or if the changes can't be logged, the whole table file is rewritten.
+        # If shared, the table is locked while saving and changes saved by others are merged rather than overwritten
+
+        saved = self._save_locked(tbl)
+        self.enforce_budget()
+        return saved
+
+    @timed
+    def _save_locked(self, tbl):
+
+        # save_tbl without enforcing the memory budget, so save_all_tbls can enforce it once all its threads are done
+
         if tbl in self.database.keys():
-            self.database[tbl].write_csv(self.reference[tbl])
+            if (self.database[tbl] is None) or (not self.is_dirty(tbl)):
+                return True
+
+            try:
+                with self.table_lock(tbl):
+                    self._save_tbl(tbl)
+                return True
+            except TimeoutError as e:
+                warnings.warn(f'{tbl} not saved: {e}')
+                return False
+        else:
+            return False
+
+    def _save_tbl(self, tbl):
+
+        # buffered entries are part of the version being saved
+        self.flush(tbl)
+        version = self.versions.get(tbl, 0)
+        changes = self.changes.get(tbl, [])
+        if self.write_log and (changes is not None) and os.path.exists(self.reference[tbl]):
+            # appended changes apply on top of whatever others saved, the table is reloaded by refresh() if they did
+            changed = self.file_changed(tbl)
+            if len(changes):
+                with open(self.log_path(tbl), 'a') as f:
+                    for change in changes:
+                        f.write(json.dumps(change, default = encode_log_value) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.changes[tbl] = []
+            if self.shared:
+                self.bases[tbl] = self.database[tbl]
+            if not changed:
+                self.file_stamps[tbl] = self.file_stamp(tbl) | {'hash': self.file_stamps.get(tbl, {}).get('hash')}
+        else:
+            self._compact(tbl)
+        self.saved_versions[tbl] = version
+
+    @timed
+    def save_all_tbls(self, workers = 4):
+
+        # Save dirty tables in parallel on a thread pool. Returns the tables written
+
+        dirty = self.get_dirty_tables()
+        for tbl in dirty:
+            self.flush(tbl)
+
+        if len(dirty) > 1 and workers > 1:
+            with ThreadPoolExecutor(max_workers = workers) as pool:
+                list(pool.map(self._save_locked, dirty))
+        else:
+            for tbl in dirty:
+                self._save_locked(tbl)
+        self.enforce_budget()
+        return dirty
+
+    def compact(self, tbl = None):
+
+        # Fold change logs into the table files: rewrite the table (with its log replayed) and remove the log. 
+        # Compacts all tables if tbl is None
+
+        if tbl is None:
+            for k in self.reference.keys():
+                if (self.database[k] is not None) or os.path.exists(self.log_path(k)):
+                    self.compact(k)
             return True
+
+        if self.load_table(tbl):
+            try:
+                with self.table_lock(tbl):
+                    self._compact(tbl)
+                self.enforce_budget()
+                return True
+            except TimeoutError as e:
+                warnings.warn(f'{tbl} not compacted: {e}')
+                return False
         else:
             return False
 
-    def save_all_tbls(self):
-        for k,v in self.reference.items():
-            if self.database[k] is not None:
-                self.database[k].write_csv(v)
+    def _compact(self, tbl):
+        self.flush(tbl)
+        if self.shared and self.file_changed(tbl):
+            self.merge_from_disk(tbl)
+
+        self._write_table(tbl)
+        if os.path.exists(self.log_path(tbl)):
+            os.remove(self.log_path(tbl))
+        self.changes[tbl] = []
+        if self.shared:
+            self.bases[tbl] = self.database[tbl]
+        self.saved_versions[tbl] = self.versions.get(tbl, 0)
+        self.file_stamps[tbl] = self.file_stamp(tbl)
+
+    def migrate_storage(self, storage, folder = None):
+
+        # Convert all tables to another storage format, written to folder (default: the current folder). Tables are
+        # loaded with the schema so typed formats store the schema's dtypes. The database uses the new files afterwards
+        # (except for 'sqlite'). e.g. searchingAPI('/Database').migrate_storage('parquet')
+
+        if folder is None:
+            folder = self.init_dir
+        os.makedirs(folder, exist_ok = True)
+
+        if storage == 'sqlite':
+            # tables are copied into a database file in folder, open it with storage = 'sqlite' to use it
+            from sql_database import SqlDatabase
+            self.load_all()
+            sql = SqlDatabase(folder, schema = {tbl: dict(self.schema[tbl]) for tbl in self.get_tables()}, indexes = self.index_cols, create = True)
+            for tbl in self.get_tables():
+                sql.delete_entries(tbl, {})
+                sql.write_entries(tbl, self.database[tbl])
+            sql.save_all_tbls()
+            return [sql.path]
+
+        if type(storage) == str:
+            storage = STORAGE[storage]
+
+        self.load_all()
+        for tbl in self.get_tables():
+            if self.load_table(tbl):
+                path = os.path.join(folder, tbl + storage.ext)
+                storage.write(self.database[tbl], path + '.tmp')
+                os.replace(path + '.tmp', path)
+                self.reference[tbl] = path
+
+        self.storage = storage
+        self.init_dir = folder
+        return list(self.reference.values())
 
     def delete_tbl(self, tbl):
         if self.load_table(tbl):
             self.database.pop(tbl)
             self.schema.pop(tbl)
+            self.key_templates.pop(tbl, None)
             self.reference.pop(tbl)
+            self.index_cols.pop(tbl, None)
+            self.indexes.pop(tbl, None)
+            self.pending.pop(tbl, None)
+            self.pending_rows.pop(tbl, None)
+
+# Integer surrogate keys (assigned by buildingAPI) are used for joins once every row of a table has them. 
+# Expressions that are true for rows whose keys are set; link tables hold study_key
+SURROGATE_KEYED = {
+    'studies': pl.col('study_key').is_not_null() & (pl.col('proposal_id').is_null() | pl.col('proposal_key').is_not_null()) 
+                & (pl.col('report_id').is_null() | pl.col('report_key').is_not_null()),
+    'documents': pl.col('document_key').is_not_null() & pl.col('study_key').is_not_null(),
+}
+
+# Study fields searchingAPI keeps bitmaps for, and the table each is in. Years of study_date are indexed as 'year'
+BITMAP_FIELDS = {'client': 'studies', 'species': 'studies', 'sex': 'studies', 
+                 'method': 'study_methods', 'compound': 'study_compounds', 'strain': 'study_strains'}
+
+# Tables searchingAPI results are read from. Cached results are dropped when any of them changes version
+SEARCH_TABLES = ['studies', 'documents'] + sorted(set(t for t in BITMAP_FIELDS.values() if t != 'studies'))
+
+# Bit of each position within a byte, for expanding bitmaps into masks
+BITS = pl.Series([1, 2, 4, 8, 16, 32, 64, 128], dtype = pl.UInt8)
+
+def to_bitmap(positions):
+
+    # Bitmap (python int with bit i set for row i) of a list of row positions
+
+    if len(positions) == 0:
+        return 0
+    buf = bytearray((max(positions) >> 3) + 1)
+    for p in positions:
+        buf[p >> 3] |= 1 << (p & 7)
+    return int.from_bytes(buf, 'little')
+
+class BitmapIndex():
+
+    # Inverted index from field values to bitmaps of the rows of a studies frame that have them. Bitmaps are python ints
+    # (bit i set for row i), so criteria combine with & and | and an empty result is 0. Values in fewer than 1 in 64 rows 
+    # are kept as lists of row positions, which take less memory than a bitmap, and converted when used
+
+    def __init__(self, studies, fields):
+
+        # studies: DataFrame - rows are numbered by position
+        # fields: dict of {field: LazyFrame of 'value' and 'row'} - the studies rows each value is found in. Kept as 
+        #       self.pairs for counting values within a selection (see counts)
+        
+        self.studies = studies
+        self.n = len(studies)
+        self.all = (1 << self.n) - 1
+        nbytes = (self.n + 7) // 8
+        self.pairs = dict(zip(fields.keys(), pl.collect_all([pairs.drop_nulls().unique() for pairs in fields.values()])))
+
+        # dense values are aggregated into the bits set in each byte of their bitmap, sparse values into their rows
+        plans = []
+        for pairs in self.pairs.values():
+            pairs = pairs.lazy().with_columns(pl.len().over('value').alias('count'))
+            dense = pairs.filter(pl.col('count') * 64 >= self.n)
+            sparse = pairs.filter(pl.col('count') * 64 < self.n)
+            plans.append(dense.group_by('value', (pl.col('row') // 8).cast(pl.UInt32).alias('byte')).agg((2 ** (pl.col('row') % 8)).sum().cast(pl.UInt8).alias('bits')))
+            plans.append(sparse.group_by('value').agg(pl.col('row').sort()))
+        collected = pl.collect_all(plans)
+
+        self.values = {}
+        for i, field in enumerate(fields.keys()):
+            dense, sparse = collected[2 * i], collected[2 * i + 1]
+            index = {value: rows for value, rows in sparse.iter_rows()}
+            for (value,), data in dense.partition_by('value', as_dict = True).items():
+                buf = pl.zeros(nbytes, dtype = pl.UInt8, eager = True).scatter(data['byte'], data['bits'])
+                index[value] = int.from_bytes(bytes(buf.to_list()), 'little')
+            self.values[field] = index
+
+        positions = pl.int_range(self.n, eager = True)
+        self.byte = (positions // 8).cast(pl.UInt32)
+        self.bit = BITS.gather(positions % 8)
+
+    def get(self, field, values):
+
+        # Bitmap of the rows with any of values in field
+
+        index = self.values.get(field, {})
+        bitmap = 0
+        for value in values:
+            entry = index.get(value, 0)
+            if type(entry) == list:
+                entry = to_bitmap(entry)
+            bitmap |= entry
+        return bitmap
+
+    def mask(self, bitmap):
+
+        # Boolean Series over the studies rows, true where the bitmap's bit is set
+
+        data = pl.Series(list(bitmap.to_bytes((self.n + 7) // 8, 'little')), dtype = pl.UInt8)
+        return (data.gather(self.byte) & self.bit) != 0
+
+    def rows(self, bitmap):
+        return self.studies.filter(self.mask(bitmap))
+
+    def counts(self, bitmaps):
+
+        # Number of rows with each value of each field among the rows of a bitmap per field, {field: bitmap}, 
+        # counted with one group by per field. Returns {field: {value: count}} including values with no rows
+
+        masks = {}
+        plans = []
+        for field, bitmap in bitmaps.items():
+            if bitmap not in masks.keys():
+                masks[bitmap] = self.mask(bitmap)
+            plans.append(self.pairs[field].lazy().filter(pl.lit(masks[bitmap]).gather(pl.col('row'))).group_by('value').len())
+
+        counts = {}
+        for field, counted in zip(bitmaps.keys(), pl.collect_all(plans)):
+            counts[field] = dict.fromkeys(self.values[field].keys(), 0)
+            counts[field].update(counted.iter_rows())
+        return counts
+
+def sex_values(sex):
+
+    # Sexes a searched sex matches: studies on both sexes match either
+    
+    if sex == 'males':
+        return ['males', 'both']
+    elif sex == 'females':
+        return ['females', 'both']
+    else:
+        return [sex]
+
+def species_values(species):
+
+    # Species a searched species matches: rat and mouse studies match either
+
+    if species == 'rat':
+        return ['rat', 'rat and mouse']
+    elif species == 'mouse':
+        return ['mouse', 'rat and mouse']
+    else:
+        return [species]
+
+class SearchCriteria():
+
+    # What to search studies for with searchingAPI.search. Criteria left as None match every study. Studies match all of
+    # methods and all of compounds, like repeated filter_by_method and filter_by_compound calls.
+    # years: int or tuple of (first, last) year of study_date
+
+    def __init__(self, methods = None, compounds = None, client = None, sex = None, species = None, strain = None, years = None):
+
+        self.methods = tuple(sorted(set(methods))) if methods else None
+        self.compounds = tuple(sorted(set(compounds))) if compounds else None
+        self.client = client or None
+        self.sex = sex or None
+        self.species = species or None
+        self.strain = strain or None
+        if type(years) == int:
+            years = (years, years)
+        self.years = tuple(years) if years else None
+
+    def key(self):
+        return (self.methods, self.compounds, self.client, self.sex, self.species, self.strain, self.years)
+
+    def without(self, field):
+
+        # Copy of the criteria with one of client, sex, species, strain or years left out
+
+        values = {'methods': self.methods, 'compounds': self.compounds, 'client': self.client, 'sex': self.sex, 
+                  'species': self.species, 'strain': self.strain, 'years': self.years}
+        values[field] = None
+        return SearchCriteria(**values)
+
+    def terms(self):
+
+        # List of (field, values) that a study must match one of the values of, for each term
+
+        terms = [('method', [m]) for m in self.methods or []] + [('compound', [c]) for c in self.compounds or []]
+        if self.client is not None:
+            terms.append(('client', [self.client]))
+        if self.sex is not None:
+            terms.append(('sex', sex_values(self.sex)))
+        if self.species is not None:
+            terms.append(('species', species_values(self.species)))
+        if self.strain is not None:
+            terms.append(('strain', [self.strain]))
+        if self.years is not None:
+            terms.append(('year', list(range(self.years[0], self.years[1] + 1))))
+        return terms
 
 class searchingAPI(CsvDatabase):
 
-    def __init__(self, folder = None):
+    def __init__(self, folder = None, lazy = False, storage = DEFAULT_STORAGE, cache_size = 128):
+
+        # lazy: boolean - tables are scanned from file when queried rather than loaded (see CsvDatabase)
+        # storage: str - file format of the tables, or 'sqlite' (see CsvDatabase). Defaults to DEFAULT_STORAGE
+        # cache_size: int - number of search results kept for repeated searches (see cached). 0 turns the cache off
+
         if folder is None:
             folder = "/Database"
 
         schema = {
             
-            'documents' : {'document_id': str, 'study_id': str, 'document_number': int, 'document_name':str, 'document_type':str, 'ext': str, 'directory': str, 'last_modified': datetime,
-                                   'created': datetime, 'filepath': str, 'version': float},
+            'documents' : {'document_id': str, 'study_id': str, 'document_number': int, 'document_name':str, 'document_type': pl.Categorical, 'ext': str, 'directory': str, 
+                           'last_modified': datetime, 'created': datetime, 'filepath': str, 'version': float, 'document_key': int, 'study_key': int},
             'studies': {'study_id': str, 'study_number': int, 'study_date': datetime, 
-                        'client': str, 'species': str, 'sex': str,'description': str, 
+                        'client': pl.Categorical, 'species': pl.Categorical, 'sex': pl.Categorical,'description': str, 
                         'proposal_id': str, 'proposal_issue_date': datetime, 'proposal_latest_reissue': datetime, 
-                        'report_id': str, 'report_issue_date': datetime, 'report_latest_reissue': datetime},
-            'study_employees': {'study_id' : str, 'employee': str, 'role': str},
-            'study_methods': {'study_id':str, 'method':str},
-            'study_compounds' : {'study_id':str, 'compound': str},
-            'study_strains': {'study_id': str, 'strain': str},
+                        'report_id': str, 'report_issue_date': datetime, 'report_latest_reissue': datetime,
+                        'study_key': int, 'proposal_key': int, 'report_key': int},
+            'study_employees': {'study_id' : str, 'employee': str, 'role': pl.Categorical, 'study_key': int},
+            'study_methods': {'study_id':str, 'method': pl.Categorical, 'study_key': int},
+            'study_compounds' : {'study_id':str, 'compound': pl.Categorical, 'study_key': int},
+            'study_strains': {'study_id': str, 'strain': pl.Categorical, 'study_key': int},
             'scraped_files': {'filepath': str, 'success': bool}
 
         }
 
 
-        super().__init__(folder, schema = schema)
+        super().__init__(folder, schema = schema, lazy = lazy, storage = storage)
+        self.keyed = {}
+        self.bitmaps = None
+        self.bitmap_lock = threading.Lock()
+        self.cache_size = cache_size
+        self.results = OrderedDict()
+        self.results_version = None
+        self.cache_lock = threading.Lock()
+        self.selection = None
+        self.selection_terms = []
         self.create_filtered()
+        if 'studies' in self.database.keys():
+            self.bitmap_index()
         
     def create_filtered(self):
-        if self.load_table('studies'):
+
+        # self.filtered is a LazyFrame of the studies matching the filter_by_* calls since. Filters narrow self.selection,
+        # a bitmap from bitmap_index, and the selected rows are read out when self.filtered is next used
+
+        if 'studies' in self.database.keys():
             
-            self.filtered = self.database['studies']
+            self.filtered = self.scan('studies')
+            self.selection = None
+            self.selection_terms = []
+            self.sort_dates = False
             # s.map_elements(dateparser.parse, return_dtype = pl.datatypes.Datetime))
             # self.filtered = self.filtered.with_columns(self.filtered['study_date'].str.to_date('%m/%d/%y'))
 
+    def has_keys(self, tbl):
+
+        # True if every row of tbl and of studies has its surrogate keys (see SURROGATE_KEYED). Checked once per version of the tables
+
+        version = (self.versions.get('studies', 0), self.versions.get(tbl, 0))
+        if self.keyed.get(tbl, (None,))[0] != version:
+            keyed = True
+            for t in set(['studies', tbl]):
+                expr = SURROGATE_KEYED.get(t, pl.col('study_key').is_not_null())
+                keyed &= bool(self.scan(t).select(expr.all()).collect().item())
+            self.keyed[tbl] = (version, keyed)
+        return self.keyed[tbl][1]
+
+    def study_key(self, tbl):
+
+        # Column to join a link table to studies on: the integer study_key when populated, otherwise study_id
+
+        if self.has_keys(tbl):
+            return 'study_key'
+        else:
+            return 'study_id'
+
+    def bitmap_index(self):
+
+        # BitmapIndex of the BITMAP_FIELDS and study years, built from the studies and link tables and rebuilt when any 
+        # of them changed since. The index is never modified, so queries can keep using one while it is replaced
+
+        tables = ['studies'] + sorted(set(t for t in BITMAP_FIELDS.values() if (t != 'studies') and (t in self.database.keys())))
+        version = tuple(self.versions.get(t, 0) for t in tables)
+        bitmaps = self.bitmaps
+        if (bitmaps is not None) and (bitmaps[0] == version):
+            return bitmaps[1]
+
+        with self.bitmap_lock:
+            if (self.bitmaps is None) or (self.bitmaps[0] != version):
+                # loading tables bumps their versions, so they're read after scanning
+                frames = {t: self.scan(t) for t in tables}
+                version = tuple(self.versions.get(t, 0) for t in tables)
+                studies = frames['studies'].collect()
+                numbered = studies.lazy().with_row_index('row')
+                fields = {'year': numbered.select(pl.col('study_date').dt.year().alias('value'), 'row')}
+                for field, tbl in BITMAP_FIELDS.items():
+                    if tbl == 'studies':
+                        fields[field] = numbered.select(pl.col(field).alias('value'), 'row')
+                    elif tbl in self.database.keys():
+                        key = self.study_key(tbl)
+                        fields[field] = frames[tbl].select(key, pl.col(field).alias('value')).join(numbered.select(key, 'row'), on = key).select('value', 'row')
+                self.bitmaps = (version, BitmapIndex(studies, fields))
+            bitmaps = self.bitmaps
+        return bitmaps[1]
+
+    def plan(self, criteria, index = None):
+
+        # Bitmap of the studies matching a SearchCriteria, and the BitmapIndex it refers to. Terms on tables the 
+        # database doesn't have are ignored, like the filter_by_* methods do
+
+        if index is None:
+            index = self.bitmap_index()
+        bitmap = index.all
+        for field, values in criteria.terms():
+            if BITMAP_FIELDS.get(field, 'studies') in self.database.keys():
+                bitmap &= index.get(field, values)
+                if bitmap == 0:
+                    break
+        return index, bitmap
+
+    def search_version(self):
+        return tuple(self.versions.get(t, 0) for t in SEARCH_TABLES)
+
+    def cached(self, key, compute):
+
+        # Result of compute() for key from a least recently used cache of cache_size results, computing and caching it on
+        # a miss. The cache is emptied when any of SEARCH_TABLES changes version, and results computed while one changed
+        # (e.g. by loading it) aren't kept. Results are shared between callers, so they aren't to be modified
+
+        if not self.cache_size:
+            return compute()
+
+        version = self.search_version()
+        with self.cache_lock:
+            if self.results_version != version:
+                self.results.clear()
+                self.results_version = version
+            elif key in self.results.keys():
+                self.results.move_to_end(key)
+                return self.results[key]
+
+        result = compute()
+        with self.cache_lock:
+            if (self.search_version() == version) and (self.results_version == version):
+                self.results[key] = result
+                while len(self.results) > self.cache_size:
+                    self.results.popitem(last = False)
+        return result
+
+    def search(self, criteria):
+
+        # DataFrame of the studies matching a SearchCriteria, sorted by study_date if years are given. Unlike 
+        # the filter_by_* methods this keeps no query state, so threads and windows can search one instance at once.
+        # Repeated searches are answered from the result cache
+
+        return self.cached(('search', criteria.key()), lambda: self._search(criteria))
+
+    def _search(self, criteria):
+        index, bitmap = self.plan(criteria)
+        studies = index.rows(bitmap)
+        if criteria.years is not None:
+            studies = studies.sort(by = 'study_date')
+        return studies
+
+    def search_docs(self, criteria):
+
+        # Proposals and reports of the studies matching a SearchCriteria (as get_matching_docs)
+
+        return self.cached(('search_docs', criteria.key()), lambda: self.matching_docs(self.search(criteria).lazy()))
+
+    def facet_counts(self, criteria = None):
+
+        # Number of studies that would match criteria with each value of each field added, e.g. to show counts next to
+        # search options and grey out the ones with none. Returns {field: {value: count}} for 'method', 'compound', 'client', 
+        # 'strain', 'species', 'sex' and 'year'. Methods and compounds add to the criteria's, so they are counted within the
+        # current matches. The others replace the criteria's own value, so they are counted without it. Sex and species
+        # counts include the studies their search matches (e.g. 'males' counts studies on both sexes)
+
+        if criteria is None:
+            criteria = SearchCriteria()
+        return self.cached(('facet_counts', criteria.key()), lambda: self._facet_counts(criteria))
+
+    def _facet_counts(self, criteria):
+        index = self.bitmap_index()
+        _, matched = self.plan(criteria, index)
+        replaced = {'client': 'client', 'strain': 'strain', 'species': 'species', 'sex': 'sex', 'year': 'years'}
+
+        bitmaps = {}
+        for field in ['method', 'compound', 'client', 'strain', 'species', 'sex', 'year']:
+            if field not in index.values.keys():
+                continue
+            if (field in replaced.keys()) and (getattr(criteria, replaced[field]) is not None):
+                bitmaps[field] = self.plan(criteria.without(replaced[field]), index)[1]
+            else:
+                bitmaps[field] = matched
+
+        counts = index.counts(bitmaps)
+        for field, expand in [('sex', sex_values), ('species', species_values)]:
+            if field in counts.keys():
+                counts[field] = {value: sum(counts[field].get(v, 0) for v in expand(value)) for value in counts[field].keys()}
+        return counts
+
+    def select_bitmap(self, field, values):
+
+        # Narrow the selection to studies with any of values in field and update self.filtered. Bits are row positions
+        # in one BitmapIndex, so if the tables changed since the last filter, the earlier terms are applied again on the new index
+
+        index = self.bitmap_index()
+        self.selection_terms.append((field, values))
+        if (self.selection is None) or (index is not self.selection_index):
+            self.selection = index.all
+            for term_field, term_values in self.selection_terms:
+                self.selection &= index.get(term_field, term_values)
+        else:
+            self.selection &= index.get(field, values)
+        self.selection_index = index
+        self._filtered = None
+
+    @property
+    def filtered(self):
+        if self._filtered is None:
+            self._filtered = self.selection_index.rows(self.selection).lazy()
+            if self.sort_dates:
+                self._filtered = self._filtered.sort(by = 'study_date')
+        return self._filtered
+
+    @filtered.setter
+    def filtered(self, frame):
+        self._filtered = frame
+
     def get_possible_years(self):
-        return self.filtered['study_date'].dt.year().min(), self.filtered['study_date'].dt.year().max()
+        years = self.filtered.select(pl.col('study_date').dt.year().min().alias('min'), pl.col('study_date').dt.year().max().alias('max')).collect()
+        return years['min'].item(), years['max'].item()
 
     def get_possible_methods(self):
-        if self.load_table('study_methods'):
+        if 'study_methods' in self.database.keys():
 
             # method_count = self.database['document_methods'].group_by('method').len().sort('len', descending = True)
-            method_count = self.database['study_methods'].unique('method')['method'].to_list()
+            method_count = self.scan('study_methods').select(pl.col('method').unique().drop_nulls()).collect()['method'].to_list()
 
 
             return sorted(method_count, key=str.casefold)
 
     def get_possible_compounds(self):
-        if self.load_table('study_compounds'):
+        if 'study_compounds' in self.database.keys():
 
             # compound_count = self.database['document_compounds'].group_by('compound').len().sort('len', descending = True)
-            compound_count = self.database['study_compounds'].unique('compound')['compound'].to_list()
+            compound_count = self.scan('study_compounds').select(pl.col('compound').unique().drop_nulls()).collect()['compound'].to_list()
             return sorted(compound_count, key = str.casefold)
 
     def get_possible_clients(self):
-        if self.load_table('studies'):
+        if 'studies' in self.database.keys():
         
             # client_count = self.database['documents'].group_by('client').len().sort('len', descending = True)
-            client_count = self.database['studies'].unique('client')['client'].to_list()
+            client_count = self.scan('studies').select(pl.col('client').unique().drop_nulls()).collect()['client'].to_list()
             return sorted(client_count, key = str.casefold)
     
     def get_possible_strains(self, species= None):
-        if self.load_table('study_strains'):
-            strain_count =  self.database['study_strains'].unique('strain')['strain'].to_list()
+        if 'study_strains' in self.database.keys():
+            strain_count =  self.scan('study_strains').select(pl.col('strain').unique().drop_nulls()).collect()['strain'].to_list()
             return sorted(strain_count, key = str.casefold)
             # if species is not None:
             #     return self.database['studies'].filter(pl.col('Species')== species)['strain'].to_list()
@@ -546,84 +2292,87 @@ class searchingAPI(CsvDatabase):
             #     return self.database['strain']['Name'].to_list()
 
     def filter_by_method(self, method):
-        if self.load_table('study_methods'):
+        if 'study_methods' in self.database.keys():
 
-            filtered_docs= self.database['study_methods'].filter(pl.col('method')== method).select('study_id')
-            self.filtered = self.filtered.filter(pl.col('study_id').is_in(filtered_docs))
+            self.select_bitmap('method', [method])
         
     def filter_by_compound(self, compound):
-        if  self.load_table('study_compounds'):
+        if 'study_compounds' in self.database.keys():
 
-            filtered_docs= self.database['study_compounds'].filter(pl.col('compound')== compound).select('study_id')
-            self.filtered = self.filtered.filter(pl.col('study_id').is_in(filtered_docs))
+            self.select_bitmap('compound', [compound])
 
     def filter_by_client(self, client):
-        if self.load_table('studies'):
+        if 'studies' in self.database.keys():
 
-            filtered_docs= self.database['studies'].filter(pl.col('client')== client).select('study_id')
-            self.filtered = self.filtered.filter(pl.col('study_id').is_in(filtered_docs))
+            self.select_bitmap('client', [client])
 
     def filter_by_sex(self, sex):
-        if self.load_table('studies'):
+        if 'studies' in self.database.keys():
 
-            if sex == 'males':
-                sex = ['males', 'both']
-            elif sex == 'females':
-                sex = ['females', 'both']
-            else:
-                sex = [sex]
-
-            filtered_docs= self.database['studies'].filter(pl.col('sex').is_in(sex)).select('study_id')
-            self.filtered = self.filtered.filter(pl.col('study_id').is_in(filtered_docs))
+            self.select_bitmap('sex', sex_values(sex))
 
     def filter_by_species(self, species):
-        if self.load_table('studies'):
+        if 'studies' in self.database.keys():
 
-            if species == 'rat':
-                species = ['rat', 'rat and mouse']
-            elif species == 'mouse':
-                species = ['mouse', 'rat and mouse']
-            else:
-                species = [species]
-
-            filtered_docs= self.database['studies'].filter(pl.col('species').is_in(species)).select('study_id')
-            self.filtered = self.filtered.filter(pl.col('study_id').is_in(filtered_docs))
+            self.select_bitmap('species', species_values(species))
 
     def filter_by_strain(self, strain):
-        if self.load_table('study_strains'):
+        if 'study_strains' in self.database.keys():
 
-            filtered_docs= self.database['study_strains'].filter(pl.col('strain')== strain).select('study_id')
-            self.filtered = self.filtered.filter(pl.col('study_id').is_in(filtered_docs))
+            self.select_bitmap('strain', [strain])
 
     def filter_by_date(self, year):
         
+        self.sort_dates = True
         if type(year) == tuple:
-            self.filtered = self.filtered.filter(pl.col('study_date').is_between(datetime(year[0], 1, 1), datetime(year[1], 12, 31))).sort(by = 'study_date')
+            self.select_bitmap('year', list(range(year[0], year[1] + 1)))
         else:
-            self.filtered = self.filtered.filter(pl.col('study_date').is_between(datetime(year, 1, 1), datetime(year, 12, 31))).sort(by = 'study_date')
+            self.select_bitmap('year', [year])
     
     def get_matching_db(self):
-        return self.filtered
+        return self.filtered.collect()
 
     def get_matching_docs(self):
         ## change this  
         # if self.load_table('studies'):
-        if self.load_table('documents'):
-            matched_proposals = self.database['documents'].filter(pl.col('document_id').is_in(self.filtered['proposal_id'])).select(['study_id', 'filepath'])
-            matched_reports = self.database['documents'].filter(pl.col('document_id').is_in(self.filtered['report_id'])).select(['study_id', 'filepath'])
+        if self.selection is None:
+            return self.matching_docs(self.filtered)
+        else:
+            return self.cached(('matching_docs', self.selection_index, self.selection), lambda: self.matching_docs(self.filtered))
+
+    def matching_docs(self, studies):
+
+        # Filepaths of the proposal and report of each study in the studies LazyFrame
+
+        if 'documents' in self.database.keys():
+            if self.has_keys('documents'):
+                doc, proposal, report = 'document_key', 'proposal_key', 'report_key'
+            else:
+                doc, proposal, report = 'document_id', 'proposal_id', 'report_id'
+
+            documents = self.scan('documents').select([doc, 'study_id', 'filepath'])
+            matched_proposals = documents.join(studies.select(pl.col(proposal).alias(doc)), on = doc, how = 'semi').select(['study_id', 'filepath'])
+            matched_reports = documents.join(studies.select(pl.col(report).alias(doc)), on = doc, how = 'semi').select(['study_id', 'filepath'])
 
-            matched_data = matched_proposals.join(matched_reports, on = 'study_id',  how = 'outer', coalesce = True).rename({'filepath':'Proposals', 'filepath_right':'Reports'})
-            return matched_data
+            matched_data = matched_proposals.join(matched_reports, on = 'study_id',  how = 'full', coalesce = True).rename({'filepath':'Proposals', 'filepath_right':'Reports'})
+            return matched_data.collect()
 
     def check_filter_empty(self):
-        if len(self.filtered) == 0:
+        if self.selection is not None:
+            return self.selection == 0
+        elif self.filtered.limit(1).collect().is_empty():
             return True
         else:
             return False
         
 class referenceAPI(CsvDatabase):
 
-    def __init__(self, folder = None):
+    def __init__(self, folder = None, storage = None, write_log = False, shared = False):
+
+        # storage: str - file format of the tables, or 'sqlite' (see CsvDatabase)
+        # write_log: boolean - saves append to per-table change logs instead of rewriting files (see CsvDatabase)
+        # shared: boolean - lock tables while saving and merge changes saved by other users (see CsvDatabase)
+
         if folder is None:
             folder = "/Reference"
 
@@ -662,7 +2411,8 @@ class referenceAPI(CsvDatabase):
                 "Search 2": str,
             },
         }
-        super().__init__(folder, schema = schema)
+        indexes = {'clients': ['client', 'client_code'], 'methods': ['method']}
+        super().__init__(folder, schema = schema, indexes = indexes, storage = storage, write_log = write_log, shared = shared)
     
     def get_possible_models(self):
         if self.load_table('methods'):
@@ -718,6 +2468,7 @@ class referenceAPI(CsvDatabase):
         return model_code
 
     def check_client_code(self, code):
+        self.load_table('clients')
         primary = self.database['clients'].filter(pl.col('client_code') == code)
 
         # columns_to_check = ['scrape', 'alt 1', 'alt 2']
@@ -728,6 +2479,7 @@ class referenceAPI(CsvDatabase):
         return primary, scraping
         
     def check_model_code(self, code):
+        self.load_table('methods')
         found = self.database['methods'].filter(pl.col('method_code') == code)
         return found
 
@@ -746,7 +2498,26 @@ class referenceAPI(CsvDatabase):
         return written
 
 
+if __name__ == "__main__":
+
+    # Convert a database folder to another storage format using an API's schema, e.g.
+    #   python custom_database.py /Database parquet --api searching
 
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Migrate a database folder to another storage format')
+    parser.add_argument('folder')
+    parser.add_argument('storage', choices = list(STORAGE.keys()) + ['sqlite'])
+    parser.add_argument('--api', choices = ['searching', 'reference'], default = None, help = 'schema to store tables with (default: inferred)')
+    parser.add_argument('--source', choices = list(STORAGE.keys()), default = 'csv')
+    parser.add_argument('--dest', default = None, help = 'output folder (default: folder)')
+    args = parser.parse_args()
 
+    if args.api == 'searching':
+        db = searchingAPI(args.folder, storage = args.source)
+    elif args.api == 'reference':
+        db = referenceAPI(args.folder, storage = args.source)
+    else:
+        db = CsvDatabase(args.folder, storage = args.source)
 
-        
\ No newline at end of file
+    for path in db.migrate_storage(args.storage, folder = args.dest):
+        print(path)
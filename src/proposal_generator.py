@@ -4,7 +4,7 @@ from PyQt5.QtWidgets import QApplication, QLabel, QVBoxLayout, QHBoxLayout, QWid
 from PyQt5.QtCore import  Qt, QDate
 from functools import partial  
 
-from custom_database import searchingAPI, referenceAPI
+from custom_database import searchingAPI, referenceAPI, SearchCriteria
 from proposal_filling import *
 
 class MainWindow(QWidget):
@@ -13,7 +13,10 @@ class MainWindow(QWidget):
         super().__init__()
 
         self.api = searchingAPI("/Volumes/Company/Becca/Study Database/Database")
-        self.ref = referenceAPI("/Volumes/Company/Becca/Study Database/Reference")
+        self.ref = referenceAPI("/Volumes/Company/Becca/Study Database/Reference", write_log = True, shared = True)
+        # tables only needed on later pages load in the background
+        self.api.preload(['documents', 'study_methods', 'study_strains'])
+        self.ref.preload()
         # initialize all parameters
         self.page_index = 0 
         self.title = None
@@ -839,13 +842,11 @@ class MainWindow(QWidget):
         if client_code is None:
             client_code = '---'
 
-        self.api.filter_by_client(self.client)
-        last_study = self.api.get_matching_db()['study_number'].max()
+        last_study = self.api.search(SearchCriteria(client = self.client))['study_number'].max()
         if last_study is None:
             study_num = 1
         else:
             study_num = last_study +1
-        self.api.create_filtered()
         
         # Format Date
         month_map = {
@@ -1241,8 +1242,8 @@ class SearchWindow(QWidget):
 
     def __init__(self, item, mw):
         super().__init__()
-        self.api  = searchingAPI("/Database")
-        self.api.create_filtered()
+        # searches the main window's database, search() keeps no state between windows
+        self.api = mw.api
         self.mw = mw
         self.item = item
         # Set up window properties
@@ -1356,7 +1357,6 @@ class SearchWindow(QWidget):
     def last_page(self):
         self.clearLayout(self.display_layout)
         self.stacked_layout.setCurrentIndex(0)
-        self.api.create_filtered()
 
     def clearLayout(self, layout):
         if layout is not None:
@@ -1369,53 +1369,20 @@ class SearchWindow(QWidget):
 
     def search_docs(self):    
         
-        self.api.create_filtered()
-        self.api.filter_by_method(self.item)
-        
-        if self.api.check_filter_empty():
-            QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-            return
-        
-                
+        criteria = {'methods': [self.item]}
         if (self.mw.species is not None) and (self.species_check.isChecked()):
-            print(self.mw.species)
-            self.api.filter_by_species(self.mw.species.lower())
-            if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
-        
+            criteria['species'] = self.mw.species.lower()
         if (self.mw.strain is not None) and (self.strain_check.isChecked()):
-            self.api.filter_by_strain(self.mw.strain)
-            if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
-
-
+            criteria['strain'] = self.mw.strain
         if (self.mw.sex is not None) and (self.sex_check.isChecked()):
-            self.api.filter_by_sex(self.mw.sex.lower())
-            if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
-            
+            criteria['sex'] = self.mw.sex.lower()
         if (self.mw.client is not None) and (self.client_check.isChecked()):
-            self.api.filter_by_client(self.mw.client)
-            if self.api.check_filter_empty():
-                QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-                return
-        
-
-
-            
-
-        # self.api.filter_by_date((self.lower_year, self.upper_year))
-        # if self.api.check_filter_empty():
-        #         QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
-        #         return
+            criteria['client'] = self.mw.client
 
-        
-        #     # self.found_docs = fin
-
-        self.filepaths = self.api.get_matching_docs()
+        self.filepaths = self.api.search_docs(SearchCriteria(**criteria))
+        if (self.filepaths is None) or self.filepaths.is_empty():
+            QMessageBox.information(self, "No Matches Found", "No documents matched criteria")
+            return
         for row in self.filepaths.iter_rows():
             # row[0] = study id
             self.add_text(row[0], title = True)
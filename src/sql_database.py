@@ -0,0 +1,628 @@
+import os
+import json
+import sqlite3
+import time
+import threading
+import warnings
+from contextlib import contextmanager
+from datetime import datetime, date
+from functools import lru_cache
+import polars as pl
+from custom_database import CsvDatabase, STORAGE, compile_schema, entries_as_dict, timed
+
+SQL_FN = 'database.sqlite'
+
+# Columns given an index in every table that has them, on top of the indexes declared per table
+SQL_INDEXED = ['study_id', 'filepath', 'document_id']
+
+SQL_TYPES = {'INTEGER': int, 'REAL': float, 'TEXT': str}
+
+def table_files(folder):
+
+    # Files in folder holding tables in one of the file storage formats
+
+    if not os.path.isdir(folder):
+        return []
+    return [fn for fn in os.listdir(folder) if any(fn.endswith(storage.ext) for storage in STORAGE.values())]
+
+def sql_type(dtype):
+    if dtype is None:
+        return 'TEXT'
+    elif (dtype == pl.Boolean) or dtype.is_integer():
+        return 'INTEGER'
+    elif dtype.is_float():
+        return 'REAL'
+    else:
+        return 'TEXT'
+
+def read_dtype(dtype):
+
+    # dtype rows are read as before casting to the schema: dates and times are stored as ISO strings, booleans as 0/1
+
+    if dtype is None:
+        return None
+    elif (dtype == pl.Boolean) or dtype.is_integer():
+        return pl.Int64
+    elif dtype.is_float():
+        return pl.Float64
+    else:
+        return pl.String
+
+def sql_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    elif type(value) == bool:
+        return int(value)
+    else:
+        return value
+
+@lru_cache(maxsize = None)
+def sql_backend(cls):
+
+    # The class used for cls when storage = 'sqlite': the API's own methods on top of SqlDatabase
+
+    if issubclass(cls, SqlDatabase):
+        return cls
+    elif cls is CsvDatabase:
+        return SqlDatabase
+    else:
+        return type(cls.__name__, (cls, SqlDatabase), {'__module__': cls.__module__})
+
+class SqlDatabase(CsvDatabase):
+
+    # CsvDatabase on an embedded SQLite file instead of a file per table. Lookups, inserts, updates and deletes run as SQL
+    # against indexed tables, so tables don't have to fit in memory. A table is only read into self.database when a caller
+    # needs the whole frame (load_table, scan), and that copy is dropped when the table changes.
+    # Changes are held in an open SQL transaction until saved. Selected with storage = 'sqlite' (see CsvDatabase)
+
+    def __init__(self, folder, schema = None, strict = False, expand_tbls = False, expand_fields = False, indexes = None, buffer_size = 1000, lazy = False,
+                 storage = 'sqlite', write_log = False, shared = False, memory_budget = None, create = False):
+
+        # folder: folder holding the database file (SQL_FN), or the path of a .sqlite/.db file
+        # create: boolean - start a database file even if the folder holds table files of another storage (see migrate_storage).
+        #       Otherwise opening a folder that hasn't been migrated raises, instead of reading an empty database
+        # Other arguments as CsvDatabase. Tables are never buffered, and write_log and shared aren't needed: SQLite journals
+        # and locks the file itself. memory_budget applies to the frame copies read by load_table
+
+        if os.path.splitext(folder)[1] in ('.sqlite', '.db'):
+            path = folder
+        else:
+            path = os.path.join(folder, SQL_FN)
+
+        # a folder of table files without a database file hasn't been migrated, rather than starting an empty database next to them
+        files = table_files(os.path.dirname(path) or '.')
+        if files and (not create) and (not os.path.exists(path)):
+            raise FileNotFoundError(f"{path} not found but {os.path.dirname(path)} holds table files, copy them in with migrate_storage('sqlite')")
+
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.sql_lock = threading.RLock()
+        if files and (not create) and all(self.is_empty(tbl) for tbl in self.sql_tables()):
+            self.conn.close()
+            raise ValueError(f"{path} has no entries but {os.path.dirname(path)} holds table files, copy them in with migrate_storage('sqlite')")
+
+        self._init_state(folder, None, strict, expand_fields, buffer_size, lazy, False, shared, memory_budget)
+        self.storage = 'sqlite'
+
+        for tbl in self.sql_tables():
+            if (schema is None) or ((tbl not in schema.keys()) and expand_tbls):
+                self.add_sql_table(tbl, self.sql_schema(tbl))
+        if schema:
+            for tbl, tbl_schema in schema.items():
+                self.add_sql_table(tbl, tbl_schema)
+
+        if indexes:
+            for tbl, cols in indexes.items():
+                for c in cols:
+                    self.add_index(tbl, c)
+        for tbl in self.database.keys():
+            for col in SQL_INDEXED:
+                if col in self.schema[tbl]:
+                    self.add_index(tbl, col)
+
+        with self.sql_lock:
+            self.conn.commit()
+
+    def execute(self, query, params = (), many = False):
+
+        # Run a statement, returns the number of rows it changed
+
+        with self.sql_lock:
+            if many:
+                cursor = self.conn.executemany(query, params)
+            else:
+                cursor = self.conn.execute(query, params)
+            return cursor.rowcount
+
+    def sql_tables(self):
+        with self.sql_lock:
+            return [row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+
+    def is_empty(self, tbl):
+        with self.sql_lock:
+            return self.conn.execute(f'SELECT 1 FROM "{tbl}" LIMIT 1').fetchone() is None
+
+    def sql_schema(self, tbl):
+        with self.sql_lock:
+            return {row[1]: SQL_TYPES.get(row[2].upper(), str) for row in self.conn.execute(f'PRAGMA table_info("{tbl}")')}
+
+    def add_sql_table(self, tbl, schema):
+
+        # Create the table if needed and add any schema columns it is missing
+
+        dtypes = compile_schema(schema).dtypes
+        if tbl not in self.sql_tables():
+            columns = ', '.join(f'"{col}" {sql_type(dtype)}' for col, dtype in dtypes.items())
+            self.execute(f'CREATE TABLE "{tbl}" ({columns})')
+        else:
+            existing = self.sql_schema(tbl)
+            for col, dtype in dtypes.items():
+                if col not in existing:
+                    self.execute(f'ALTER TABLE "{tbl}" ADD COLUMN "{col}" {sql_type(dtype)}')
+
+        self.database[tbl] = None
+        self.reference[tbl] = self.path
+        self.schema[tbl] = dict(schema)
+        self.key_templates.pop(tbl, None)
+
+    def add_index(self, tbl, cols):
+
+        # Declared indexes are SQL indexes, maintained by SQLite on every write
+
+        if type(cols) == str:
+            cols = (cols,)
+        else:
+            cols = tuple(cols)
+
+        if (tbl in self.database.keys()) and (cols not in self.index_cols.setdefault(tbl, [])):
+            self.index_cols[tbl].append(cols)
+            name = '__'.join((tbl,) + cols)
+            columns = ', '.join(f'"{c}"' for c in cols)
+            self.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{tbl}" ({columns})')
+
+    def where(self, tbl, key):
+
+        # SQL condition and parameters for a key dict, from the key's compiled template (see CsvDatabase.key_template). 
+        # Returns None for the condition if a key column isn't in the table
+
+        terms, missing = self.key_template(tbl, key)
+        if len(missing):
+            warnings.warn(f'{missing[0]} not found in {tbl}')
+            return None, None
+
+        clauses = []
+        params = []
+        for col, _, is_list in terms:
+            val = key[col]
+            if is_list:
+                if len(val):
+                    clauses.append(f'"{col}" IN ({", ".join("?" * len(val))})')
+                    params.extend(sql_value(v) for v in val)
+                else:
+                    clauses.append('0')
+            else:
+                clauses.append(f'"{col}" = ?')
+                params.append(sql_value(val))
+
+        if len(clauses):
+            return ' WHERE ' + ' AND '.join(clauses), params
+        else:
+            return '', params
+
+    def select(self, tbl, key = None):
+
+        # Entries matching key (all entries if None) as a dataframe cast to the table schema
+
+        where, params = self.where(tbl, key or {})
+        if where is None:
+            return None
+
+        fields = self.get_fields(tbl)
+        columns = ', '.join(f'"{col}"' for col in fields)
+        with self.sql_lock:
+            rows = self.conn.execute(f'SELECT {columns} FROM "{tbl}"{where}', params).fetchall()
+
+        dtypes = compile_schema(self.schema[tbl]).dtypes
+        data = pl.DataFrame(rows, schema = {col: read_dtype(dtypes.get(col)) for col in fields}, orient = 'row', strict = False)
+        data, _ = self.match_schema(data, self.schema[tbl])
+        return data
+
+    def insert(self, tbl, data):
+
+        # Insert the rows of a dataframe, returns number of rows inserted
+
+        columns = ', '.join(f'"{col}"' for col in data.columns)
+        values = ', '.join('?' * len(data.columns))
+        rows = [tuple(sql_value(v) for v in row) for row in data.iter_rows()]
+        return self.execute(f'INSERT INTO "{tbl}" ({columns}) VALUES ({values})', rows, many = True)
+
+    def record_change(self, tbl, change):
+
+        # Changes are written to the database as they are made, so only the version is bumped (marking the table dirty
+        # until the transaction is committed) and the frame copy of the table is dropped
+
+        self.versions[tbl] = self.versions.get(tbl, 0) + 1
+        self.database[tbl] = None
+        if change is None:
+            self.key_templates.pop(tbl, None)
+
+    @timed
+    def load_table(self, tbl, merge = True):
+
+        # Reads the table into self.database. Internal writers pass merge = False and only need to know the table exists
+
+        if tbl in self.database.keys():
+            if merge and (self.memory_budget is not None):
+                self.touch(tbl)
+            if merge and (self.database[tbl] is None):
+                with self._load_lock(tbl):
+                    if self.database[tbl] is None:
+                        start = time.perf_counter()
+                        self.database[tbl] = self.select(tbl)
+                        if self.stats is not None:
+                            self.stats['load_time'][tbl] = time.perf_counter() - start
+            return True
+        else:
+            warnings.warn(f'{tbl} not found in {self.init_dir}')
+            return False
+
+    def unload_table(self, tbl):
+        if tbl in self.database.keys():
+            self.database[tbl] = None
+
+    def refresh(self):
+
+        # Changes committed by other processes are read by the next query. Frame copies of tables without
+        # uncommitted changes are dropped so they are read again. Returns the tables dropped
+
+        dropped = [tbl for tbl in self.database.keys() if (self.database[tbl] is not None) and (not self.is_dirty(tbl))]
+        for tbl in dropped:
+            self.unload_table(tbl)
+        return dropped
+
+    @timed
+    def scan(self, tbl):
+        if self.memory_budget is not None:
+            self.enforce_budget(keep = tbl)
+        if self.load_table(tbl):
+            return self.database[tbl].lazy()
+
+    def flush(self, tbl):
+        pass
+
+    def count_entries(self, tbl):
+        if tbl in self.database.keys():
+            with self.sql_lock:
+                return self.conn.execute(f'SELECT COUNT(*) FROM "{tbl}"').fetchone()[0]
+        else:
+            return 0
+
+    def find_entries(self, tbl, key, as_dict = False):
+        if tbl not in self.database.keys():
+            return False, None
+
+        entries = self.select(tbl, key)
+        if entries is None:
+            return False, None
+        elif as_dict:
+            return True, entries_as_dict(entries)
+        else:
+            return True, entries
+
+    def create_tbl(self, tbl, data = None, schema = None):
+
+        if tbl in self.database.keys():
+            warnings.warn(f"{tbl} already exists in database - nothing new created")
+        else:
+            if schema and data:
+                data, schema = self.normalize_data_by_schema(schema, data)
+            elif (schema is None) and (data is None):
+                warnings.warn('Either data or schema must be defined')
+                return False
+
+            try:
+                frame = pl.DataFrame(data = data, schema = schema, strict = self.strict)
+                if schema is None:
+                    schema = pl.Schema(frame.schema).to_python()
+                self.add_sql_table(tbl, schema)
+                if len(frame):
+                    self.insert(tbl, frame)
+                self.record_change(tbl, None)
+                return True
+            except Exception as e:
+                print(f'Error: {e.args[0]}, {tbl} not created')
+                return False
+
+    @timed
+    def _create_entry(self, tbl, data):
+
+        if not all(v is None for v in data.values()):
+            schema = self.schema[tbl]
+            if schema:
+                data, schema = self.normalize_data_by_schema(schema, data)
+
+            try:
+                entry = pl.DataFrame(data = data, schema = schema, strict = self.strict)
+            except Exception as e:
+                print(f'Error: {e.args[0]}, entry not added')
+                return False
+
+            if self.expand_fields:
+                self.add_sql_table(tbl, schema)
+            self.insert(tbl, entry)
+            self.record_change(tbl, {'op': 'insert'})
+            return True
+        else:
+            print('Will not add an empty row')
+            return False
+
+    @timed
+    def write_entries(self, tbl, data, key_cols = None, overwrite = False):
+
+        # As CsvDatabase.write_entries. Key conflicts are checked by SQLite per row against the key columns' index
+
+        if not self.load_table(tbl, merge = False):
+            warnings.warn(f'{tbl} not in database')
+            return 0
+
+        data = self.prepare_entries(tbl, data)
+        if (data is None) or (not len(data)):
+            return 0
+        if self.expand_fields:
+            self.add_sql_table(tbl, self.schema[tbl])
+
+        if not key_cols:
+            written = self.insert(tbl, data)
+        else:
+            if type(key_cols) == str:
+                key_cols = [key_cols]
+            match = ' AND '.join(f'"{col}" = ?' for col in key_cols)
+            keys = [tuple(sql_value(v) for v in row) for row in data.select(key_cols).iter_rows()]
+
+            if overwrite:
+                data = data.unique(subset = key_cols, keep = 'last', maintain_order = True)
+                self.execute(f'DELETE FROM "{tbl}" WHERE {match}', keys, many = True)
+                written = self.insert(tbl, data)
+            else:
+                data = data.unique(subset = key_cols, keep = 'first', maintain_order = True)
+                columns = ', '.join(f'"{col}"' for col in data.columns)
+                values = ', '.join('?' * len(data.columns))
+                rows = [tuple(sql_value(v) for v in row) + tuple(sql_value(v) for v in key)
+                        for row, key in zip(data.iter_rows(), data.select(key_cols).iter_rows())]
+                written = self.execute(f'INSERT INTO "{tbl}" ({columns}) SELECT {values} WHERE NOT EXISTS (SELECT 1 FROM "{tbl}" WHERE {match})',
+                                       rows, many = True)
+
+        if written:
+            self.record_change(tbl, {'op': 'insert'})
+        return written
+
+    @timed
+    def update_fields(self, tbl, key, data):
+
+        key, casted = self.match_schema(key, self.schema[tbl])
+        if casted and self.load_table(tbl, merge = False):
+            for col in data.keys():
+                if col not in self.get_fields(tbl):
+                    warnings.warn(f'Column: {col} not found in {tbl}')
+                    return False
+
+            replace, failed = compile_schema(self.schema[tbl]).cast_dict(dict(data))
+            if len(failed):
+                warnings.warn(f'Datatype does not match {[self.schema[tbl][col] for col in failed.keys()]}')
+                return False
+
+            where, params = self.where(tbl, key)
+            if where is None:
+                return False
+
+            columns = ', '.join(f'"{col}" = ?' for col in replace.keys())
+            updated = self.execute(f'UPDATE "{tbl}" SET {columns}{where}', [sql_value(v) for v in replace.values()] + params)
+            if updated:
+                self.record_change(tbl, {'op': 'update'})
+                return True
+            else:
+                warnings.warn(f'No matching entry, refine key')
+                return False
+        else:
+            return False
+
+    def fill_field(self, tbl, field, key_col, values):
+
+        # One UPDATE per key, only touching rows where field is null (see CsvDatabase.fill_field)
+
+        if (not len(values)) or (not self.load_table(tbl, merge = False)):
+            return 0
+        if (field not in self.get_fields(tbl)) or (key_col not in self.get_fields(tbl)):
+            warnings.warn(f'{field} or {key_col} not found in {tbl}')
+            return 0
+
+        params = [(sql_value(v), sql_value(k)) for k, v in values.items()]
+        with self.sql_lock:
+            before = self.conn.total_changes
+            self.conn.executemany(f'UPDATE "{tbl}" SET "{field}" = ? WHERE "{key_col}" = ? AND "{field}" IS NULL', params)
+            filled = self.conn.total_changes - before
+        if filled:
+            self.record_change(tbl, {'op': 'update'})
+        return filled
+
+    def add_field(self, tbl, schema = None, data = None):
+        if tbl not in self.database.keys():
+            return False
+        elif (schema is None) and (data is None):
+            return False
+
+        if schema is not None:
+            name, scheme = schema
+            if not ((type(scheme) == type) or (type(scheme) == pl.datatypes.classes.DataTypeClass)):
+                warnings.warn('Schema must have a valid datatype (python or polars)')
+                return False
+        else:
+            name = data[0]
+            scheme = type(data[1][0] if type(data[1]) == list else data[1])
+
+        if (data is not None) and (type(data[1]) == list) and (len(data[1]) != self.count_entries(tbl)):
+            warnings.warn('Data must be a single value or list matching height of table')
+            return False
+
+        self.add_sql_table(tbl, self.schema[tbl] | {name: scheme})
+        if data is not None:
+            if type(data[1]) != list:
+                self.execute(f'UPDATE "{tbl}" SET "{name}" = ?', (sql_value(data[1]),))
+            else:
+                with self.sql_lock:
+                    rowids = [row[0] for row in self.conn.execute(f'SELECT rowid FROM "{tbl}" ORDER BY rowid')]
+                self.execute(f'UPDATE "{tbl}" SET "{name}" = ? WHERE rowid = ?', [(sql_value(v), r) for v, r in zip(data[1], rowids)], many = True)
+        self.record_change(tbl, None)
+        return True
+
+    def delete_field(self, tbl, field):
+        if tbl in self.database.keys():
+            if field in self.get_fields(tbl):
+                self.execute(f'ALTER TABLE "{tbl}" DROP COLUMN "{field}"')
+                self.schema[tbl].pop(field)
+                self.index_cols[tbl] = [cols for cols in self.index_cols.get(tbl, []) if field not in cols]
+                self.record_change(tbl, None)
+            else:
+                warnings.warn(f'{field} not in {tbl}')
+        else:
+            return False
+
+    @timed
+    def delete_entries(self, tbl, key):
+        if tbl in self.database.keys():
+            deleted = self.select(tbl, key)
+            if deleted is None:
+                return None
+
+            if len(deleted):
+                where, params = self.where(tbl, key)
+                self.execute(f'DELETE FROM "{tbl}"{where}', params)
+                self.record_change(tbl, {'op': 'delete'})
+            return deleted
+        else:
+            print(f'{tbl} not found in {self.init_dir}')
+            return None
+
+    def delete_tbl(self, tbl):
+        if tbl in self.database.keys():
+            self.execute(f'DROP TABLE "{tbl}"')
+            for d in [self.database, self.schema, self.reference, self.index_cols, self.versions, self.saved_versions]:
+                d.pop(tbl, None)
+
+    def get_stats(self, as_json = False):
+
+        # As CsvDatabase.get_stats, with row counts of tables that aren't loaded counted in the database
+
+        report = super().get_stats()
+        for tbl, table in report['tables'].items():
+            if table['rows'] is None:
+                table['rows'] = self.count_entries(tbl)
+        if as_json:
+            return json.dumps(report, indent = 1)
+        else:
+            return report
+
+    def get_dirty_tables(self):
+        return [tbl for tbl in self.database.keys() if self.is_dirty(tbl)]
+
+    @timed
+    def save_tbl(self, tbl):
+
+        # Commits the open transaction. This saves every table, SQLite has one transaction per connection
+
+        if tbl in self.database.keys():
+            self.save_all_tbls()
+            return True
+        else:
+            return False
+
+    def save_all_tbls(self, workers = 4):
+        dirty = self.get_dirty_tables()
+        with self.sql_lock:
+            self.conn.commit()
+        for tbl in self.database.keys():
+            self.saved_versions[tbl] = self.versions.get(tbl, 0)
+        self.enforce_budget()
+        return dirty
+
+    def compact(self, tbl = None):
+
+        # Nothing to fold in, changes are saved and the database file is rebuilt without free pages
+
+        self.save_all_tbls()
+        with self.sql_lock:
+            self.conn.execute('VACUUM')
+        return True
+
+    @contextmanager
+    def transaction(self):
+
+        # As CsvDatabase.transaction, on a SQL savepoint. Rolling back undoes the block's changes in the database
+
+        if self.transaction_state is not None:
+            yield self
+            return
+
+        self.transaction_state = {
+            'schema': {k: dict(v) for k, v in self.schema.items()},
+            'versions': dict(self.versions),
+        }
+        with self.sql_lock:
+            if not self.conn.in_transaction:
+                self.conn.execute('BEGIN')
+            self.conn.execute('SAVEPOINT transaction_block')
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        else:
+            self.transaction_state = None
+            try:
+                self.execute('RELEASE transaction_block')
+            except sqlite3.OperationalError:
+                # saved inside the block
+                pass
+
+    def rollback(self):
+        state = self.transaction_state
+        self.transaction_state = None
+        if state is None:
+            return False
+
+        try:
+            self.execute('ROLLBACK TO transaction_block')
+            self.execute('RELEASE transaction_block')
+        except sqlite3.OperationalError:
+            warnings.warn('Changes saved inside the transaction were not rolled back')
+            return False
+
+        for tbl in list(self.database.keys()):
+            if tbl not in state['schema'].keys():
+                for d in [self.database, self.schema, self.reference, self.index_cols, self.versions, self.saved_versions]:
+                    d.pop(tbl, None)
+            elif self.versions.get(tbl, 0) != state['versions'].get(tbl, 0):
+                self.database[tbl] = None
+                self.schema[tbl] = state['schema'][tbl]
+                self.key_templates.pop(tbl, None)
+                self.versions[tbl] = state['versions'].get(tbl, 0)
+        return True
+
+    def migrate_storage(self, storage, folder = None):
+
+        # Write every table to files of another storage format in folder. The database keeps using the SQL file
+
+        if type(storage) == str:
+            storage = STORAGE[storage]
+        if folder is None:
+            folder = os.path.dirname(self.path)
+        os.makedirs(folder, exist_ok = True)
+
+        paths = []
+        for tbl in self.get_tables():
+            if self.load_table(tbl):
+                path = os.path.join(folder, tbl + storage.ext)
+                storage.write(self.database[tbl], path + '.tmp')
+                os.replace(path + '.tmp', path)
+                paths.append(path)
+        return paths
@@ -9,7 +9,7 @@ import polars as pl
 import numpy as np
 from docx import Document, text
 from nlp_funcs import find_persons
-from custom_database import CsvDatabase
+from custom_database import CsvDatabase, DEFAULT_STORAGE
 
 def find_study_pattern(text):
     pattern = r"[^{(_\s.]{2,6}_\d{2,3}_\d{1,2}[A-Za-z]*\d{2,4}"
@@ -793,33 +793,54 @@ class MeliorStudy():
     
 class buildingAPI(CsvDatabase):
 
-    def __init__(self, folder, ref_db = None):
+    def __init__(self, folder, ref_db = None, storage = DEFAULT_STORAGE, shared = False, memory_budget = None):
+
+        # storage: str - file format of the tables, or 'sqlite' (see CsvDatabase). Defaults to DEFAULT_STORAGE, ref_db is always csv
+        # shared: boolean - lock tables while saving and merge changes saved by other users, so scraping can run 
+        #       while the database is in use (see CsvDatabase)
+        # memory_budget: int - bytes of tables kept loaded, so a long scrape stays within a fixed amount of memory. 
+        #       Least recently used tables that have been saved are unloaded first (see CsvDatabase)
+
         if folder is None:
             folder = "/Databases"
 
         if ref_db is None:
             self.ref_db = CsvDatabase("/Databases")
         else:
-            self.ref_db = CsvDatabase(folder = ref_db)
+            self.ref_db = CsvDatabase(folder = ref_db, indexes = {'clients': ['client']})
             self.ref_db.load_all()
 
         schema = {
             
-            'documents' : {'document_id': str, 'study_id': str, 'document_number': int, 'document_name':str, 'document_type':str, 'ext': str, 'directory': str, 'last_modified': datetime,
-                                   'created': datetime, 'filepath': str, 'version': float},
+            'documents' : {'document_id': str, 'study_id': str, 'document_number': int, 'document_name':str, 'document_type': pl.Categorical, 'ext': str, 'directory': str, 
+                           'last_modified': datetime, 'created': datetime, 'filepath': str, 'version': float, 'document_key': int, 'study_key': int},
             'studies': {'study_id': str, 'study_number': int, 'study_date': datetime, 
-                        'client': str, 'species': str, 'sex': str,'description': str, 
+                        'client': pl.Categorical, 'species': pl.Categorical, 'sex': pl.Categorical,'description': str, 
                         'proposal_id': str, 'proposal_issue_date': datetime, 'proposal_latest_reissue': datetime, 
-                        'report_id': str, 'report_issue_date': datetime, 'report_latest_reissue': datetime},
-            'study_employees': {'study_id' : str, 'employee': str, 'role': str},
-            'study_methods': {'study_id':str, 'method':str},
-            'study_compounds' : {'study_id':str, 'compound': str},
-            'study_strains': {'study_id': str, 'strain': str},
+                        'report_id': str, 'report_issue_date': datetime, 'report_latest_reissue': datetime,
+                        'study_key': int, 'proposal_key': int, 'report_key': int},
+            'study_employees': {'study_id' : str, 'employee': str, 'role': pl.Categorical, 'study_key': int},
+            'study_methods': {'study_id':str, 'method': pl.Categorical, 'study_key': int},
+            'study_compounds' : {'study_id':str, 'compound': pl.Categorical, 'study_key': int},
+            'study_strains': {'study_id': str, 'strain': pl.Categorical, 'study_key': int},
             'scraped_files': {'filepath': str, 'success': bool}
 
         }
 
-        super().__init__(folder, schema = schema)
+        # key columns looked up for every scraped document
+        indexes = {
+            'documents': ['filepath', ('study_id', 'document_type'), 'document_id'],
+            'studies': ['study_id'],
+            'study_employees': [('study_id', 'role')],
+            'study_methods': ['study_id', ('study_id', 'method')],
+            'study_compounds': ['study_id', ('study_id', 'compound')],
+            'study_strains': ['study_id', ('study_id', 'strain')],
+            'scraped_files': ['filepath']
+        }
+
+        super().__init__(folder, schema = schema, indexes = indexes, storage = storage, shared = shared, memory_budget = memory_budget)
+        self.next_keys = {}
+        self.study_keys = {}
         self.load_database()
 
     def load_database(self):
@@ -827,10 +848,94 @@ class buildingAPI(CsvDatabase):
             if tbl not in self.database.keys():
                 self.create_tbl(tbl, data = None, schema = self.schema[tbl])
 
+    # Integer surrogate keys. Studies and documents get dense integer keys (study_key, document_key) that are stored
+    # with every row referring to them, so searchingAPI can join on integers instead of string IDs
+    def new_key(self, tbl, col):
+
+        # Next unused key, counted from the largest key in any table storing col. Keys kept for studies not written
+        # yet are already stored with their documents and link tables, so they aren't handed out again
+
+        if col not in self.next_keys:
+            largest = None
+            for t in [tbl] + [t for t in self.schema.keys() if (t != tbl) and (col in self.schema[t])]:
+                if self.load_table(t):
+                    value = self.database[t].select(pl.col(col).max()).item()
+                    if (value is not None) and ((largest is None) or (value > largest)):
+                        largest = value
+            self.next_keys[col] = 0 if largest is None else largest + 1
+
+        key = self.next_keys[col]
+        self.next_keys[col] += 1
+        return key
+
+    def get_study_key(self, study_id):
+
+        # Key of a study, or a new key kept for it if the study hasn't been written yet (documents are written before their study).
+        # A study without a row yet keeps the key its documents and link tables were given
+
+        if study_id not in self.study_keys:
+            found, study = self.get_entries('studies', {'study_id': study_id}, as_dict = True)
+            if found and (study['study_key'] is not None) and (type(study['study_key']) != list):
+                self.study_keys[study_id] = study['study_key']
+            else:
+                for tbl in ['documents', 'study_employees', 'study_methods', 'study_compounds', 'study_strains']:
+                    found, rows = self.get_entries(tbl, {'study_id': study_id})
+                    if found and len(rows):
+                        kept = rows['study_key'].drop_nulls()
+                        if len(kept):
+                            self.study_keys[study_id] = kept[0]
+                            break
+                else:
+                    self.study_keys[study_id] = self.new_key('studies', 'study_key')
+        return self.study_keys[study_id]
+
+    def get_document_key(self, document_id):
+        found, doc = self.get_entries('documents', {'document_id': document_id}, as_dict = True)
+        if found and (type(doc['document_key']) != list):
+            return doc['document_key']
+        else:
+            return None
+
+    def assign_keys(self):
+
+        # Give studies and documents written before surrogate keys existed their keys, and copy the keys to the rows
+        # referring to them. Keys are filled in place (see fill_field), so rows are never duplicated and running again
+        # keys nothing. Returns number of rows keyed
+
+        keyed = 0
+        for tbl, col, id_col in [('studies', 'study_key', 'study_id'), ('documents', 'document_key', 'filepath')]:
+            if self.load_table(tbl):
+                missing = self.database[tbl].filter(pl.col(col).is_null() & pl.col(id_col).is_not_null())[id_col].unique(maintain_order = True)
+                if len(missing):
+                    if tbl == 'studies':
+                        keys = {study_id: self.get_study_key(study_id) for study_id in missing.to_list()}
+                    else:
+                        keys = {doc_id: self.new_key(tbl, col) for doc_id in missing.to_list()}
+                    keyed += self.fill_field(tbl, col, id_col, keys)
+
+        if not (self.load_table('studies') and self.load_table('documents')):
+            return keyed
+        documents = self.database['documents'].filter(pl.col('document_key').is_not_null())
+        doc_keys = dict(zip(documents['document_id'].to_list(), documents['document_key'].to_list()))
+
+        # studies refer to their proposal and report
+        for ref in ['proposal', 'report']:
+            keyed += self.fill_field('studies', ref + '_key', ref + '_id', doc_keys)
+
+        # documents and link tables refer to their study
+        for tbl in ['documents', 'study_employees', 'study_methods', 'study_compounds', 'study_strains']:
+            if self.load_table(tbl):
+                stale = self.database[tbl].filter(pl.col('study_key').is_null() & pl.col('study_id').is_not_null())
+                if len(stale):
+                    study_keys = {study_id: self.get_study_key(study_id) for study_id in stale['study_id'].unique().to_list()}
+                    keyed += self.fill_field(tbl, 'study_key', 'study_id', study_keys)
+
+        return keyed
+
     def get_document_number(self, ms):
 
-        if self.load_table('documents'):
-            if len(self.database['documents']) != 0:
+        if self.load_table('documents', merge = False):
+            if self.count_entries('documents') != 0:
                 filter_by = {'study_id': ms.study_id, 'document_type': ms.document_type}
                 found, target_docs = self.get_entries('documents', filter_by, as_dict = False)
                 last_doc_num = target_docs.select('document_number')
@@ -843,8 +948,8 @@ class buildingAPI(CsvDatabase):
             
     def is_latest_document(self, ms):
 
-        if self.load_table('documents'):
-            if len(self.database['documents']) != 0:
+        if self.load_table('documents', merge = False):
+            if self.count_entries('documents') != 0:
                 filter_by = {'study_id': ms.study_id, 'document_type': ms.document_type}
                 found, target_docs = self.get_entries('documents', key =filter_by, as_dict = False)
                 if len(target_docs) != 0:
@@ -889,7 +994,7 @@ class buildingAPI(CsvDatabase):
         else:
             date = ms.created.strftime('%d') + month_map[ms.created.month] + ms.created.strftime('%y')
         
-        if len(self.database['studies']):
+        if self.load_table('studies') and len(self.database['studies']):
             all_ids = self.database['studies'].select(pl.col('study_id').str.split('_').list.to_struct()).unnest('study_id')
             all_ids = all_ids.with_columns([(pl.col("field_2").map_elements(lambda x: dateparser.parse(x), return_dtype = datetime).alias('date'))]).unique()
 
@@ -909,7 +1014,7 @@ class buildingAPI(CsvDatabase):
         
     # Finding if specific elements are in the database
     def has_filepath(self, fp):
-        if self.load_table('documents'):
+        if self.load_table('documents', merge = False):
             found, dn = self.get_entries('documents', {'filepath': fp})
             if found:
                 if len(dn) == 1:
@@ -928,9 +1033,10 @@ class buildingAPI(CsvDatabase):
             return None
         
     def has_study(self, study_id):
-        if self.load_table('studies'):
+        if self.load_table('studies', merge = False):
         
-            if study_id in self.database['studies']['study_id']:
+            found, matches = self.get_entries('studies', {'study_id': study_id})
+            if found and len(matches):
                 return True
             else:
                 return False
@@ -957,25 +1063,27 @@ class buildingAPI(CsvDatabase):
             if ms.study_date is None:
                 ms.study_date = study_date
         
-        # new is boolean indicating if a ms is a new entry. updates contains dict of all new things added or entries updated in documents table
-        # doc_id is the document id in documents table
-        new, updates, doc_id = self.update_documents(ms, update = rescrape) 
-        print(f'document updates: {updates}')
-
-        # if nothing new was created and we're not rescraping, then return study id, and booleans to indicate if it was created or updated
-        if (not new) and (not rescrape):
-            return ms.study_id, updated_data, created_data, None
-        else: 
-            if scraped:
-                # if the study id exists and this document is the latest document, update the study information. 
-                # if study id exists and this document is not the latests, do nothing.
-                if self.has_study(ms.study_id): 
-                    if self.is_latest_document(ms):
-                        self.update_study_with_document(ms, doc_id, delete_old = rescrape) 
-                        updated_data = True
-                # if study id not in databse, create a new study using this document
-                else: 
-                    created_data = self.create_study_with_document(ms, doc_id)
+        # the document and study entries are written in one transaction, so a failure part way leaves neither
+        with self.transaction():
+            # new is boolean indicating if a ms is a new entry. updates contains dict of all new things added or entries updated in documents table
+            # doc_id is the document id in documents table
+            new, updates, doc_id = self.update_documents(ms, update = rescrape) 
+            print(f'document updates: {updates}')
+
+            # if nothing new was created and we're not rescraping, then return study id, and booleans to indicate if it was created or updated
+            if (not new) and (not rescrape):
+                return ms.study_id, updated_data, created_data, None
+            else: 
+                if scraped:
+                    # if the study id exists and this document is the latest document, update the study information. 
+                    # if study id exists and this document is not the latests, do nothing.
+                    if self.has_study(ms.study_id): 
+                        if self.is_latest_document(ms):
+                            self.update_study_with_document(ms, doc_id, delete_old = rescrape) 
+                            updated_data = True
+                    # if study id not in databse, create a new study using this document
+                    else: 
+                        created_data = self.create_study_with_document(ms, doc_id)
 
         return ms.study_id, updated_data, created_data, ms.get_data_adds()
 
@@ -984,32 +1092,28 @@ class buildingAPI(CsvDatabase):
         doc_data, study_data = ms.get_document_entries()
         if doc_data['document_type'] == 'proposal':
             study_data['proposal_id'] = doc_id
+            study_data['proposal_key'] = self.get_document_key(doc_id)
             study_data['proposal_issue_date'] = study_data.pop('issue_date')
             study_data['proposal_latest_reissue'] = study_data.pop('latest_reissue')
         elif doc_data['document_type'] == 'report':
             study_data['report_id'] = doc_id
+            study_data['report_key'] = self.get_document_key(doc_id)
             study_data['report_issue_date'] = study_data.pop('issue_date')
             study_data['report_latest_reissue'] = study_data.pop('latest_reissue')
         else:
             print(f'{study_data["document_name"]} is not a report or proposal')
             return False
         
+        study_key = self.get_study_key(ms.study_id)
+        study_data['study_key'] = study_key
         self.write_entry('studies', key = {'study_id': ms.study_id}, data = study_data)
 
         methods, compounds, people, strain = ms.get_document_data()
-        for m in methods:
-            if m is not None:
-                self.write_entry('study_methods', key = {'study_id': ms.study_id, 'method': m}, data = {'study_id': ms.study_id, 'method': m})
-        for c in compounds:
-            if c is not None:
-                self.write_entry('study_compounds', key = {'study_id': ms.study_id, 'compound': c}, data = {'study_id': ms.study_id, 'compound': c})
-        for s in strain:
-            if s is not None:
-                self.write_entry('study_strains', key = {'study_id': ms.study_id, 'strain': s}, data ={'study_id': ms.study_id, 'strain': s})
-        for k,v in people.items():
-            if v is not None:
-                if k is not None:
-                    self.write_entry('study_employees', key = {'study_id': ms.study_id, 'role': k}, data = {'study_id': ms.study_id, 'employee': v, 'role': k})
+        self.write_entries('study_methods', [{'study_id': ms.study_id, 'method': m, 'study_key': study_key} for m in methods if m is not None], key_cols = ['study_id', 'method'])
+        self.write_entries('study_compounds', [{'study_id': ms.study_id, 'compound': c, 'study_key': study_key} for c in compounds if c is not None], key_cols = ['study_id', 'compound'])
+        self.write_entries('study_strains', [{'study_id': ms.study_id, 'strain': s, 'study_key': study_key} for s in strain if s is not None], key_cols = ['study_id', 'strain'])
+        self.write_entries('study_employees', [{'study_id': ms.study_id, 'employee': v, 'role': k, 'study_key': study_key} for k,v in people.items() if (k is not None) and (v is not None)], 
+                           key_cols = ['study_id', 'role'])
 
         return True
     
@@ -1018,10 +1122,12 @@ class buildingAPI(CsvDatabase):
         doc_data, study_data = ms.get_document_entries()
         if doc_data['document_type'] == 'proposal':
             study_data['proposal_id'] = doc_id
+            study_data['proposal_key'] = self.get_document_key(doc_id)
             study_data['proposal_issue_date'] = study_data.pop('issue_date')
             study_data['proposal_latest_reissue'] = study_data.pop('latest_reissue')
         elif doc_data['document_type'] == 'report':
             study_data['report_id'] = doc_id
+            study_data['report_key'] = self.get_document_key(doc_id)
             study_data['report_issue_date'] = study_data.pop('issue_date')
             study_data['report_latest_reissue'] = study_data.pop('latest_reissue')
         else:
@@ -1046,7 +1152,8 @@ class buildingAPI(CsvDatabase):
                 found, db_data = self.get_entries('study_employees', {'study_id': ms.study_id, 'role': k}, as_dict = True)
                 if found & (db_data['employee'] != v) & (v is not None):
                     # self.delete_entries('study_employees', {'study_id': ms.study_id, 'role': k})
-                    self.write_entry('study_employees', key = {'study_id': ms.study_id, 'role': k}, data = {'study_id': ms.study_id, 'role': k, 'employee': v}, overwrite = True)
+                    self.write_entry('study_employees', key = {'study_id': ms.study_id, 'role': k}, 
+                                     data = {'study_id': ms.study_id, 'role': k, 'employee': v, 'study_key': self.get_study_key(ms.study_id)}, overwrite = True)
                     
         
         return True
@@ -1069,6 +1176,8 @@ class buildingAPI(CsvDatabase):
             else:
                 let = 'U'
             doc_data['document_id'] = doc_data['study_id']+ '_' + let + str(doc_num).zfill(2)
+            doc_data['document_key'] = self.new_key('documents', 'document_key')
+            doc_data['study_key'] = self.get_study_key(doc_data['study_id'])
             written =  self.write_entry('documents',  data = doc_data,  key = {'filepath': doc_data['filepath']}, overwrite = False)
             if written:
                 updates = doc_data
@@ -1105,7 +1214,7 @@ class buildingAPI(CsvDatabase):
         new_items = [x for x in dat if x not in db_data]
         for x in new_items:
             if x is not None:
-                self.write_entry(tbl,  data = {'study_id': study_id, dat_key: x})
+                self.write_entry(tbl,  data = {'study_id': study_id, dat_key: x, 'study_key': self.get_study_key(study_id)})
         
         if delete_old:
             unmatched_items = [x for x in db_data if x not in dat]
@@ -1118,17 +1227,28 @@ class buildingAPI(CsvDatabase):
     # Bulk adding of data by searching folder. Will search for all .docx in dirpath
     # if rescrape is False, only filepaths NOT previously scraped will be examined
     # if rescrape is True, ALL filepaths will be scraped
-    def scrape_folder(self, dirpath, rescrape = False): 
+    # if checkpoint is set, changed tables are saved every checkpoint documents
+    def scrape_folder(self, dirpath, rescrape = False, checkpoint = None): 
         add_log = []
+        attempted = 0
+        scraped = []
+        failed = []
+
+        # rows from before surrogate keys get theirs first, so everything written here can be joined on them
+        self.assign_keys()
+
+        # filepaths already attempted, checked once instead of a lookup per file
+        if self.load_table('scraped_files'):
+            previous = set(self.database['scraped_files']['filepath'].to_list())
+        else:
+            previous = set()
+
         for filename in glob.iglob(os.path.join(dirpath, '**', '*.docx'), recursive=True):
             if '~$' not in filename:
 
                 attempt = True
-                found, db_data = self.get_entries('scraped_files', {'filepath':filename}, as_dict= False)
-                if found:
-                    if len(db_data):
-                        if rescrape is False:
-                            attempt = False
+                if (filename in previous) and (rescrape is False):
+                    attempt = False
 
                 if attempt:
                     try:
@@ -1136,7 +1256,7 @@ class buildingAPI(CsvDatabase):
                         # created_data: boolean if a study was created using this document.
                         # adds: dict of things found in document that aren't present in the references
                         study_id, updated_data, created_data, adds = self.add_filepath(filename, rescrape = rescrape)
-                        self.write_entry('scraped_files', key = {'filepath': filename}, data = {'filepath': filename, 'success' : True}, overwrite = rescrape)
+                        scraped.append({'filepath': filename, 'success' : True})
 
                         for k,v in adds.items():
                             if v is not None:
@@ -1145,9 +1265,16 @@ class buildingAPI(CsvDatabase):
                         
                     except Exception as e:
                         print(f'Exception occurred when adding {filename}: {e}')
-                        self.write_entry('scraped_files', key = {'filepath': filename}, data = {'filepath': filename, 'success' : False})
+                        failed.append({'filepath': filename, 'success' : False})
+
+                    attempted += 1
+                    if checkpoint and (attempted % checkpoint == 0):
+                        self.write_entries('scraped_files', scraped, key_cols = ['filepath'], overwrite = rescrape)
+                        self.write_entries('scraped_files', failed, key_cols = ['filepath'])
+                        scraped, failed = [], []
+                        self.save_all_tbls()
     
+        self.write_entries('scraped_files', scraped, key_cols = ['filepath'], overwrite = rescrape)
+        self.write_entries('scraped_files', failed, key_cols = ['filepath'])
         
         return pl.DataFrame(add_log)
-
-
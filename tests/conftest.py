@@ -0,0 +1,8 @@
+import os
+import sys
+
+# modules in src are imported flat, as the applications do. The repository root is on the path for the
+# synthetic databases in benchmarks
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,337 @@
+import os
+import json
+import warnings
+from datetime import date, datetime
+import polars as pl
+import pytest
+
+from custom_database import CsvDatabase
+
+warnings.simplefilter('ignore')
+
+@pytest.fixture
+def folder(tmp_path):
+    pl.DataFrame({'a': [1, 2], 'b': ['x', 'y']}).write_csv(tmp_path / 't.csv')
+    return tmp_path
+
+@pytest.mark.parametrize('write_log', [False, True])
+@pytest.mark.parametrize('shared', [False, True])
+def test_write_save_reload(folder, write_log, shared):
+    db = CsvDatabase(str(folder), write_log = write_log, shared = shared)
+    db.write_entry('t', {'a': 3, 'b': 'z'})
+    db.save_tbl('t')
+    assert not db.is_dirty('t')
+
+    reloaded = CsvDatabase(str(folder))
+    assert reloaded.load_table('t')
+    assert sorted(reloaded.database['t']['a'].to_list()) == [1, 2, 3]
+
+def test_write_compact_reload(folder):
+    db = CsvDatabase(str(folder), write_log = True)
+    db.write_entry('t', {'a': 3, 'b': 'z'})
+    db.compact('t')
+    assert sorted(pl.read_csv(folder / 't.csv')['a'].to_list()) == [1, 2, 3]
+
+@pytest.fixture
+def clients(tmp_path):
+    pl.DataFrame({'client': ['A', 'B', 'C'], 'code': ['a', 'b', 'c']}).write_csv(tmp_path / 'clients.csv')
+    return tmp_path
+
+def open_shared(folder, indexed):
+    db = CsvDatabase(str(folder), shared = True, indexes = {'clients': ['client']} if indexed else None)
+    db.load_table('clients')
+    return db
+
+def saved_clients(folder):
+    return sorted(pl.read_csv(folder / 'clients.csv').iter_rows())
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_shared_merge_keeps_others_update(clients, indexed):
+    p1, p2 = open_shared(clients, indexed), open_shared(clients, indexed)
+    p1.update_field('clients', {'client': 'A'}, ('code', 'updated'))
+    p1.save_tbl('clients')
+    p2.write_entry('clients', {'client': 'E', 'code': 'e'})
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        p2.save_tbl('clients')
+    assert saved_clients(clients) == [('A', 'updated'), ('B', 'b'), ('C', 'c'), ('E', 'e')]
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_shared_merge_keeps_others_delete(clients, indexed):
+    p1, p2 = open_shared(clients, indexed), open_shared(clients, indexed)
+    p1.delete_entries('clients', {'client': 'B'})
+    p1.save_tbl('clients')
+    p2.update_field('clients', {'client': 'C'}, ('code', 'updated'))
+    p2.save_tbl('clients')
+    assert saved_clients(clients) == [('A', 'a'), ('C', 'updated')]
+
+def test_shared_merge_conflict_keeps_local(clients):
+    p1, p2 = open_shared(clients, True), open_shared(clients, True)
+    p1.update_field('clients', {'client': 'A'}, ('code', 'theirs'))
+    p1.save_tbl('clients')
+    p2.update_field('clients', {'client': 'A'}, ('code', 'ours'))
+    with pytest.warns(UserWarning, match = 'also changed by another user'):
+        p2.save_tbl('clients')
+    assert saved_clients(clients) == [('A', 'ours'), ('B', 'b'), ('C', 'c')]
+
+def test_shared_merge_conflict_without_index_warns(clients):
+    p1, p2 = open_shared(clients, False), open_shared(clients, False)
+    p1.update_field('clients', {'client': 'A'}, ('code', 'theirs'))
+    p1.save_tbl('clients')
+    p2.update_field('clients', {'client': 'A'}, ('code', 'ours'))
+    with pytest.warns(UserWarning, match = 'no index to match them by'):
+        p2.save_tbl('clients')
+    assert saved_clients(clients) == [('A', 'ours'), ('A', 'theirs'), ('B', 'b'), ('C', 'c')]
+
+def test_preload_replays_logs_once(tmp_path):
+    tables = [f't{i}' for i in range(8)]
+    for tbl in tables:
+        pl.DataFrame({'a': list(range(100)), 'b': ['x'] * 100}).write_csv(tmp_path / f'{tbl}.csv')
+    db = CsvDatabase(str(tmp_path), write_log = True)
+    for tbl in tables:
+        db.write_entries(tbl, [{'a': 100 + i, 'b': 'logged'} for i in range(200)])
+    db.save_all_tbls()
+
+    for _ in range(3):
+        db = CsvDatabase(str(tmp_path), write_log = True)
+        for future in db.preload().values():
+            future.result()
+        for tbl in tables:
+            db.write_entry(tbl, {'a': -1, 'b': 'new'})
+        db.save_all_tbls()
+
+    reloaded = CsvDatabase(str(tmp_path))
+    for tbl in tables:
+        assert reloaded.load_table(tbl)
+        assert len(reloaded.database[tbl]) == 303
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_keyed_writes_check_buffer_without_flushing(folder, indexed):
+    db = CsvDatabase(str(folder), indexes = {'t': ['a']} if indexed else None)
+    for a in range(3, 50):
+        assert db.write_entry('t', {'a': a, 'b': 'z'}, key = {'a': a})
+    assert not db.write_entry('t', {'a': 20, 'b': 'w'}, key = {'a': 20})
+    assert db.pending_rows['t'] == 47
+    assert db.get_entries('t', {'a': 20}, as_dict = True)[1] == {'a': 20, 'b': 'z'}
+    assert db.write_entries('t', [{'a': 30, 'b': 'w'}, {'a': 60, 'b': 'w'}], key_cols = 'a') == 1
+    assert db.count_entries('t') == 50
+
+def test_budget_unloads_only_on_save(tmp_path):
+    for tbl in ['t1', 't2', 't3']:
+        pl.DataFrame({'k': list(range(5000)), 'v': [f'value {i}' for i in range(5000)]}).write_csv(tmp_path / f'{tbl}.csv')
+    db = CsvDatabase(str(tmp_path), memory_budget = 1)
+    assert db.load_table('t1') and db.load_table('t2') and db.load_table('t3')
+    assert all(db.database[tbl] is not None for tbl in ['t1', 't2', 't3'])
+
+    db.write_entry('t3', {'k': -1, 'v': 'new'})
+    with db.pinned('t1'):
+        db.save_tbl('t3')
+        assert db.database['t1'] is not None
+        assert db.database['t2'] is None and db.database['t3'] is None
+    assert db.database['t1'] is None
+    assert db.find_entries('t3', {'k': -1})[1]['v'].to_list() == ['new']
+
+def test_deletes_keep_indexes_in_step(tmp_path):
+    pl.DataFrame({'a': [i % 7 for i in range(100)], 'b': [f'x{i}' for i in range(100)]}).write_csv(tmp_path / 't.csv')
+    db = CsvDatabase(str(tmp_path), indexes = {'t': ['a', 'b']})
+    assert db.get_entries('t', {'a': 3})[0]
+    db.get_entries('t', {'b': 'x5'})
+    db.delete_entries('t', {'a': 2})
+    db.write_entries('t', pl.DataFrame({'a': [3, 4], 'b': ['x10', 'x11']}), key_cols = ['b'], overwrite = True)
+    db.delete_entries('t', {'b': 'x50'})
+
+    for cols in [('a',), ('b',)]:
+        assert db.indexes['t'][cols] is not None
+        kept = db.indexes['t'][cols]
+        assert kept == db.build_index('t', cols)
+    assert db.get_entries('t', {'b': 'x10'}, as_dict = True)[1] == {'a': 3, 'b': 'x10'}
+
+@pytest.mark.parametrize('write_log', [False, True])
+def test_fill_field_fills_nulls_in_place(tmp_path, write_log):
+    pl.DataFrame({'id': ['a', 'a', 'b', None], 'note': [None, 'n', None, None], 'key': [None, None, 7, None]}, 
+                 schema = {'id': pl.String, 'note': pl.String, 'key': pl.Int64}).write_csv(tmp_path / 't.csv')
+    db = CsvDatabase(str(tmp_path), write_log = write_log)
+    assert db.fill_field('t', 'key', 'id', {'a': 1, 'b': 2}) == 2
+    assert db.fill_field('t', 'key', 'id', {'a': 1, 'b': 2}) == 0
+    db.save_tbl('t')
+
+    reloaded = CsvDatabase(str(tmp_path))
+    assert reloaded.load_table('t')
+    assert reloaded.database['t']['key'].to_list() == [1, 1, 7, None]
+
+def test_budget_enforced_when_only_reading(tmp_path):
+    for tbl in ['t1', 't2', 't3']:
+        pl.DataFrame({'k': list(range(5000)), 'v': [f'value {i}' for i in range(5000)]}).write_csv(tmp_path / f'{tbl}.csv')
+    db = CsvDatabase(str(tmp_path), memory_budget = 1)
+    assert db.load_table('t1') and db.load_table('t2')
+    assert db.get_entries('t3', {'k': 3}, as_dict = True)[1] == {'k': 3, 'v': 'value 3'}
+    assert db.database['t1'] is None and db.database['t2'] is None and db.database['t3'] is not None
+    assert db.scan('t1').select(pl.len()).collect().item() == 5000
+    assert db.database['t3'] is None
+
+@pytest.fixture
+def tables(tmp_path):
+    pl.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', 'z']}).write_csv(tmp_path / 't.csv')
+    pl.DataFrame({'c': ['p', 'q']}).write_csv(tmp_path / 'u.csv')
+    return tmp_path
+
+def rows(db, tbl):
+    db.load_table(tbl)
+    return sorted(db.database[tbl].iter_rows())
+
+def fail(db, change):
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            change(db)
+            raise RuntimeError('failed')
+
+@pytest.mark.parametrize('write_log', [False, True])
+@pytest.mark.parametrize('change', [
+    lambda db: db.write_entry('t', {'a': 4, 'b': 'w'}),
+    lambda db: db.write_entries('t', [{'a': 4, 'b': 'w'}, {'a': 1, 'b': 'v'}], key_cols = 'a', overwrite = True),
+    lambda db: db.update_fields('t', {'a': 2}, {'b': 'changed'}),
+    lambda db: db.delete_entries('t', {'a': 3}),
+], ids = ['insert', 'upsert', 'update', 'delete'])
+def test_rollback_restores_table(tables, write_log, change):
+    db = CsvDatabase(str(tables), indexes = {'t': ['a']}, write_log = write_log)
+    db.write_entry('t', {'a': 5, 'b': 'buffered'})
+    before = rows(db, 't')
+    assert db.get_entries('t', {'a': 1}, as_dict = True)[1] == {'a': 1, 'b': 'x'}
+
+    fail(db, change)
+    assert rows(db, 't') == before
+    for a, b in before:
+        assert db.get_entries('t', {'a': a}, as_dict = True)[1] == {'a': a, 'b': b}
+
+    # only the change made before the block is saved
+    db.save_tbl('t')
+    assert rows(CsvDatabase(str(tables)), 't') == before
+
+def test_rollback_unloads_table_loaded_in_block(tables):
+    db = CsvDatabase(str(tables))
+    fail(db, lambda db: db.write_entry('u', {'c': 'r'}))
+    assert db.database['u'] is None and not db.is_dirty('u')
+    assert rows(db, 'u') == [('p',), ('q',)]
+
+def test_rollback_drops_table_created_in_block(tables):
+    db = CsvDatabase(str(tables))
+    fail(db, lambda db: db.create_tbl('new', pl.DataFrame({'d': [1]})))
+    assert 'new' not in db.get_tables()
+    assert db.get_dirty_tables() == []
+
+def test_nested_transactions_join_the_outer_one(tables):
+    db = CsvDatabase(str(tables))
+    with db.transaction():
+        db.write_entry('t', {'a': 4, 'b': 'w'})
+        with db.transaction():
+            db.delete_entries('t', {'a': 1})
+    assert rows(db, 't') == [(2, 'y'), (3, 'z'), (4, 'w')]
+
+    def nested(db):
+        db.write_entry('t', {'a': 5, 'b': 'v'})
+        with db.transaction():
+            db.update_fields('t', {'a': 2}, {'b': 'changed'})
+            raise RuntimeError('failed')
+    fail(db, nested)
+    assert rows(db, 't') == [(2, 'y'), (3, 'z'), (4, 'w')]
+    assert db.transaction_state is None
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_write_entries_skips_existing_keys(folder, indexed):
+    db = CsvDatabase(str(folder), indexes = {'t': ['a']} if indexed else None)
+    written = db.write_entries('t', [{'a': 2, 'b': 'new'}, {'a': 4, 'b': 'first'}, {'a': 4, 'b': 'second'}, {'a': 5, 'b': 'w'}], key_cols = 'a')
+    assert written == 2
+    assert rows(db, 't') == [(1, 'x'), (2, 'y'), (4, 'first'), (5, 'w')]
+    assert db.write_entries('t', [{'a': 5, 'b': 'again'}], key_cols = ['a']) == 0
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_write_entries_overwrites_existing_keys(folder, indexed):
+    db = CsvDatabase(str(folder), indexes = {'t': ['a']} if indexed else None)
+    written = db.write_entries('t', pl.DataFrame({'a': [2, 4, 4], 'b': ['new', 'first', 'last']}), key_cols = 'a', overwrite = True)
+    assert written == 2
+    assert rows(db, 't') == [(1, 'x'), (2, 'new'), (4, 'last')]
+    assert db.get_entries('t', {'a': 2}, as_dict = True)[1] == {'a': 2, 'b': 'new'}
+
+def test_write_entries_without_key_appends_all(folder):
+    db = CsvDatabase(str(folder))
+    assert db.write_entries('t', [{'a': 1, 'b': 'x'}, {'a': None, 'b': None}]) == 1
+    assert rows(db, 't') == [(1, 'x'), (1, 'x'), (2, 'y')]
+    assert db.write_entries('t', 'not rows') == 0
+
+@pytest.fixture
+def events(tmp_path):
+    pl.DataFrame({'id': ['a', 'b', 'c'], 'kind': ['x', 'y', 'x'], 'when': [datetime(2020, 1, 1)] * 3, 'n': [1, 2, 3]}).write_csv(tmp_path / 'e.csv')
+    schema = {'e': {'id': str, 'kind': pl.Categorical, 'when': datetime, 'n': int}}
+    return lambda **kwargs: CsvDatabase(str(tmp_path), schema = schema, **kwargs)
+
+def test_update_fields_casts_to_schema(events):
+    db = events(indexes = {'e': ['kind']})
+    assert db.get_entries('e', {'kind': 'x'})[1].height == 2
+    assert db.update_fields('e', {'kind': 'x'}, {'kind': 'z', 'when': date(2021, 5, 6), 'n': '7'})
+    assert dict(db.database['e'].schema) == {'id': pl.String, 'kind': pl.Categorical, 'when': pl.Datetime('us'), 'n': pl.Int64}
+    assert rows(db, 'e') == [('a', 'z', datetime(2021, 5, 6), 7), ('b', 'y', datetime(2020, 1, 1), 2), ('c', 'z', datetime(2021, 5, 6), 7)]
+    assert db.get_entries('e', {'kind': 'x'})[1].height == 0
+    assert db.get_entries('e', {'kind': 'z'})[1]['id'].to_list() == ['a', 'c']
+
+@pytest.mark.parametrize('key, data', [
+    ({'id': 'a'}, {'n': 'abc'}),
+    ({'id': 'a'}, {'when': 'not a date'}),
+    ({'id': 'a'}, {'missing': 1}),
+    ({'id': 'q'}, {'n': 1}),
+], ids = ['int', 'datetime', 'column', 'key'])
+def test_update_fields_rejects_bad_updates(events, key, data):
+    db = events()
+    before = rows(db, 'e')
+    with pytest.warns(UserWarning):
+        assert not db.update_fields('e', key, data)
+    assert rows(db, 'e') == before
+    assert not db.is_dirty('e')
+
+def test_log_replays_updates_and_deletes(events, tmp_path):
+    db = events(write_log = True)
+    db.update_fields('e', {'kind': 'x'}, {'kind': 'z', 'when': datetime(2021, 5, 6, 7, 8)})
+    db.delete_entries('e', {'id': 'b'})
+    db.write_entries('e', [{'id': 'c', 'kind': 'y', 'when': None, 'n': 30}, {'id': 'd', 'kind': 'x', 'when': None, 'n': 4}], key_cols = 'id', overwrite = True)
+    db.update_fields('e', {'id': 'd'}, {'n': 40})
+    expected = rows(db, 'e')
+    db.save_tbl('e')
+
+    # only the log was written
+    assert pl.read_csv(tmp_path / 'e.csv')['id'].to_list() == ['a', 'b', 'c']
+    assert os.path.exists(db.log_path('e'))
+
+    replayed = events()
+    assert rows(replayed, 'e') == expected
+    assert not replayed.is_dirty('e')
+    replayed.compact('e')
+    assert not os.path.exists(db.log_path('e'))
+    assert rows(events(), 'e') == expected
+
+def test_stats_time_saves_of_every_table(tables):
+    db = CsvDatabase(str(tables))
+    db.enable_stats()
+    db.write_entry('t', {'a': 4, 'b': 'w'})
+    db.write_entry('u', {'c': 'r'})
+    db.save_all_tbls()
+    db.write_entry('t', {'a': 5, 'b': 'v'})
+    db.save_tbl('t')
+
+    methods = db.get_stats()['methods']
+    assert methods['save_all_tbls']['calls'] == 1
+    assert methods['save_tbl']['calls'] == 1
+    assert methods['_save_locked']['calls'] == 3
+
+def test_schema_cache_written_whole(folder, monkeypatch):
+    CsvDatabase(str(folder))
+    cache = folder / '.schema_cache.json'
+    assert 't.csv' in json.loads(cache.read_text())
+
+    # a write failing part way leaves the previous cache in place
+    pl.DataFrame({'c': [1]}).write_csv(folder / 'u.csv')
+    def failing_dump(obj, f, **kwargs):
+        f.write('{"partial')
+        raise OSError('disk full')
+    monkeypatch.setattr(json, 'dump', failing_dump)
+    CsvDatabase(str(folder))
+    assert 't.csv' in json.loads(cache.read_text())
+    assert sorted(os.listdir(folder)) == ['.schema_cache.json', 't.csv', 'u.csv']
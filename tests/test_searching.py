@@ -0,0 +1,176 @@
+import warnings
+from datetime import datetime
+import polars as pl
+import pytest
+
+from custom_database import searchingAPI, SearchCriteria
+
+warnings.simplefilter('ignore')
+
+def write_database(folder, studies):
+    pl.DataFrame({
+        'study_id': [f'S{i}' for i in range(studies)],
+        'study_date': [datetime(2015, 1, 1)] * studies,
+        'client': ['A'] * studies,
+        'species': ['rat'] * studies,
+        'sex': ['males'] * studies,
+    }).write_csv(folder / 'studies.csv')
+    pl.DataFrame({'study_id': [f'S{i}' for i in range(studies)], 'method': ['M1'] * studies}).write_csv(folder / 'study_methods.csv')
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_refresh_sees_studies_saved_elsewhere(tmp_path, lazy):
+    write_database(tmp_path, 3)
+    api = searchingAPI(str(tmp_path), lazy = lazy)
+    criteria = SearchCriteria(methods = ['M1'], client = 'A')
+    assert len(api.search(criteria)) == 3
+
+    other = searchingAPI(str(tmp_path))
+    other.write_entry('studies', {'study_id': 'S3', 'study_date': datetime(2016, 1, 1), 'client': 'A', 'species': 'rat', 'sex': 'males'})
+    other.write_entry('study_methods', {'study_id': 'S3', 'method': 'M1'})
+    other.save_all_tbls()
+
+    assert set(api.refresh()) == {'studies', 'study_methods'}
+    assert len(api.search(criteria)) == 4
+    assert api.facet_counts(SearchCriteria())['year'][2016] == 1
+
+def test_bitmap_index_reused_after_loading_tables(tmp_path):
+    write_database(tmp_path, 3)
+    api = searchingAPI(str(tmp_path))
+    index = api.bitmaps[1]
+    assert len(api.search(SearchCriteria(methods = ['M1']))) == 3
+    assert api.bitmap_index() is index
+    api.write_entry('study_methods', {'study_id': 'S0', 'method': 'M2'})
+    assert api.bitmap_index() is not index
+
+@pytest.mark.parametrize('change', ['delete', 'refresh'])
+def test_filters_follow_table_changes(tmp_path, change):
+    write_database(tmp_path, 6)
+    api = searchingAPI(str(tmp_path))
+    api.update_fields('studies', {'study_id': 'S1'}, {'client': 'B'})
+    api.update_fields('studies', {'study_id': 'S2'}, {'species': 'mouse'})
+    api.save_all_tbls()
+    api.filter_by_client('A')
+    if change == 'delete':
+        api.delete_entries('studies', {'study_id': 'S0'})
+    else:
+        other = searchingAPI(str(tmp_path))
+        other.delete_entries('studies', {'study_id': 'S0'})
+        other.save_tbl('studies')
+        assert 'studies' in api.refresh()
+    api.filter_by_species('rat')
+
+    expected = api.search(SearchCriteria(client = 'A', species = 'rat'))['study_id'].sort().to_list()
+    assert api.get_matching_db()['study_id'].sort().to_list() == expected
+    assert expected == ['S3', 'S4', 'S5']
+
+@pytest.fixture(scope = 'module')
+def synthetic(tmp_path_factory):
+    from benchmarks.generate import generate_database
+    folder = tmp_path_factory.mktemp('synthetic')
+    generate_database(str(folder), studies = 400, seed = 1)
+    return str(folder)
+
+CRITERIA = [
+    SearchCriteria(),
+    SearchCriteria(client = 'Client 0001'),
+    SearchCriteria(species = 'rat', sex = 'females'),
+    SearchCriteria(methods = ['Method 000', 'Method 001']),
+    SearchCriteria(compounds = ['CMPD-000000'], species = 'mouse'),
+    SearchCriteria(strain = 'Wistar', years = (2010, 2015)),
+    SearchCriteria(methods = ['Method 002'], client = 'Client 0000', sex = 'males', years = 2020),
+]
+
+def filter_chain(api, criteria):
+    api.create_filtered()
+    for m in criteria.methods or []:
+        api.filter_by_method(m)
+    for c in criteria.compounds or []:
+        api.filter_by_compound(c)
+    if criteria.client:
+        api.filter_by_client(criteria.client)
+    if criteria.sex:
+        api.filter_by_sex(criteria.sex)
+    if criteria.species:
+        api.filter_by_species(criteria.species)
+    if criteria.strain:
+        api.filter_by_strain(criteria.strain)
+    if criteria.years:
+        api.filter_by_date(criteria.years)
+
+def brute_force(folder, criteria):
+
+    # study_ids matching criteria, straight from the csv files
+
+    studies = pl.read_csv(f'{folder}/studies.csv', try_parse_dates = True)
+    keep = set(studies['study_id'])
+    links = {'method': 'study_methods', 'compound': 'study_compounds', 'strain': 'study_strains'}
+    for field, values in criteria.terms():
+        if field in links.keys():
+            table = pl.read_csv(f'{folder}/{links[field]}.csv')
+            matched = table.filter(pl.col(field).is_in(values))['study_id']
+        elif field == 'year':
+            matched = studies.filter(pl.col('study_date').dt.year().is_in(values))['study_id']
+        else:
+            matched = studies.filter(pl.col(field).cast(pl.String).is_in(values))['study_id']
+        keep &= set(matched)
+    return keep
+
+@pytest.mark.parametrize('criteria', CRITERIA, ids = [str(c.key()) for c in CRITERIA])
+def test_search_matches_filter_chain(synthetic, criteria):
+    api = searchingAPI(synthetic)
+    found = api.search(criteria)
+    assert set(found['study_id']) == brute_force(synthetic, criteria)
+
+    filter_chain(api, criteria)
+    assert found['study_id'].sort().to_list() == api.get_matching_db()['study_id'].sort().to_list()
+    if criteria.years:
+        assert found['study_date'].is_sorted()
+
+    docs = api.search_docs(criteria)
+    assert docs.sort('study_id').equals(api.get_matching_docs().sort('study_id'))
+
+def with_value(criteria, field, value):
+
+    # criteria with value added (methods, compounds) or in place of the criteria's own (the other fields)
+
+    values = {'methods': criteria.methods, 'compounds': criteria.compounds, 'client': criteria.client, 'sex': criteria.sex, 
+              'species': criteria.species, 'strain': criteria.strain, 'years': criteria.years}
+    if field in ('method', 'compound'):
+        values[field + 's'] = list(values[field + 's'] or []) + [value]
+    elif field == 'year':
+        values['years'] = value
+    else:
+        values[field] = value
+    return SearchCriteria(**values)
+
+@pytest.mark.parametrize('criteria', CRITERIA[:6], ids = [str(c.key()) for c in CRITERIA[:6]])
+def test_facet_counts_match_searches(synthetic, criteria):
+    api = searchingAPI(synthetic, cache_size = 0)
+    counts = api.facet_counts(criteria)
+    assert set(counts.keys()) == {'method', 'compound', 'client', 'strain', 'species', 'sex', 'year'}
+    for field, values in counts.items():
+        # the five most common values and the three rarest of each field
+        for value in sorted(values, key = lambda v: -values[v])[:5] + sorted(values, key = lambda v: values[v])[:3]:
+            assert values[value] == len(api.search(with_value(criteria, field, value))), (field, value)
+
+@pytest.mark.parametrize('write', ['studies', 'study_methods', 'delete'])
+def test_cache_emptied_after_writes(tmp_path, write):
+    write_database(tmp_path, 3)
+    api = searchingAPI(str(tmp_path))
+    criteria = SearchCriteria(methods = ['M1'])
+    first = api.search(criteria)
+    counts = api.facet_counts(criteria)
+    assert api.search(criteria) is first and api.facet_counts(criteria) is counts
+    assert len(api.results) == 2
+
+    if write == 'studies':
+        api.update_fields('studies', {'study_id': 'S0'}, {'client': 'B'})
+        assert api.facet_counts(criteria)['client'] == {'A': 2, 'B': 1}
+    elif write == 'study_methods':
+        api.write_entry('study_methods', {'study_id': 'S0', 'method': 'M2'})
+        assert api.facet_counts(criteria)['method']['M2'] == 1
+    else:
+        api.delete_entries('study_methods', {'study_id': 'S0'})
+        assert len(api.search(criteria)) == 2
+    assert len(api.results) == 1
+    assert api.search(criteria) is not first
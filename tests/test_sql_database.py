@@ -0,0 +1,79 @@
+import os
+import sys
+import subprocess
+import sqlite3
+import warnings
+import polars as pl
+import pytest
+
+from custom_database import CsvDatabase
+from sql_database import SqlDatabase, SQL_FN
+
+warnings.simplefilter('ignore')
+
+@pytest.fixture
+def folder(tmp_path):
+    pl.DataFrame({'a': [1, 2], 'b': ['x', 'y']}).write_csv(tmp_path / 't.csv')
+    return tmp_path
+
+def test_unmigrated_folder_raises(folder):
+    with pytest.raises(FileNotFoundError):
+        CsvDatabase(str(folder), storage = 'sqlite')
+    assert not os.path.exists(folder / SQL_FN)
+
+def test_empty_database_next_to_tables_raises(folder):
+    sqlite3.connect(folder / SQL_FN).execute('CREATE TABLE t (a INTEGER, b TEXT)')
+    with pytest.raises(ValueError):
+        CsvDatabase(str(folder), storage = 'sqlite')
+
+def test_migrated_folder_opens(folder):
+    CsvDatabase(str(folder)).migrate_storage('sqlite')
+    db = CsvDatabase(str(folder), storage = 'sqlite')
+    assert type(db) is SqlDatabase
+    assert db.count_entries('t') == 2
+
+def test_environment_only_switches_database_folder(folder):
+    script = ('import custom_database as cd; '
+              'assert cd.CsvDatabase(r"{0}").storage.ext == ".csv"; '
+              'assert cd.referenceAPI(r"{0}").storage.ext == ".csv"; '
+              'cd.searchingAPI(r"{0}")').format(folder)
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    env = dict(os.environ, DATABASE_STORAGE = 'sqlite', PYTHONPATH = src)
+    run = subprocess.run([sys.executable, '-W', 'ignore', '-c', script], env = env, capture_output = True, text = True)
+    assert 'FileNotFoundError' in run.stderr, run.stderr
+    assert not os.path.exists(folder / SQL_FN)
+
+@pytest.fixture
+def sql(folder):
+    CsvDatabase(str(folder)).migrate_storage('sqlite')
+    return CsvDatabase(str(folder), storage = 'sqlite')
+
+def rows(db):
+    db.load_table('t')
+    return sorted(db.database['t'].iter_rows())
+
+@pytest.mark.parametrize('change', [
+    lambda db: db.write_entry('t', {'a': 3, 'b': 'z'}),
+    lambda db: db.update_fields('t', {'a': 2}, {'b': 'changed'}),
+    lambda db: db.delete_entries('t', {'a': 1}),
+    lambda db: db.create_tbl('new', pl.DataFrame({'d': [1]})),
+], ids = ['insert', 'update', 'delete', 'create'])
+def test_rollback_to_savepoint(sql, change):
+    sql.write_entry('t', {'a': 5, 'b': 'before'})
+    with pytest.raises(RuntimeError):
+        with sql.transaction():
+            change(sql)
+            with sql.transaction():
+                sql.write_entry('t', {'a': 6, 'b': 'nested'})
+            raise RuntimeError('failed')
+    assert rows(sql) == [(1, 'x'), (2, 'y'), (5, 'before')]
+    assert 'new' not in sql.get_tables()
+
+    sql.save_all_tbls()
+    assert rows(CsvDatabase(os.path.dirname(sql.path), storage = 'sqlite')) == [(1, 'x'), (2, 'y'), (5, 'before')]
+
+def test_transaction_commits_with_the_next_save(sql):
+    with sql.transaction():
+        sql.write_entry('t', {'a': 3, 'b': 'z'})
+    sql.save_all_tbls()
+    assert rows(CsvDatabase(os.path.dirname(sql.path), storage = 'sqlite')) == [(1, 'x'), (2, 'y'), (3, 'z')]
@@ -0,0 +1,71 @@
+import warnings
+import pytest
+
+pytest.importorskip('dateparser')
+pytest.importorskip('docx')
+
+import study_scraping
+from study_scraping import buildingAPI
+
+warnings.simplefilter('ignore')
+
+def test_keys_kept_for_unwritten_studies_survive_reopening(tmp_path):
+    b = buildingAPI(str(tmp_path), ref_db = str(tmp_path))
+    key = b.get_study_key('S1')
+    b.write_entry('documents', {'document_id': 'S1_P00', 'study_id': 'S1', 'filepath': '/x/s1.docx', 'study_key': key})
+    b.save_all_tbls()
+
+    reopened = buildingAPI(str(tmp_path), ref_db = str(tmp_path))
+    assert reopened.get_study_key('S2') != key
+    assert reopened.get_study_key('S1') == key
+
+def test_assign_keys_fills_rows_with_null_columns_once(tmp_path):
+    b = buildingAPI(str(tmp_path), ref_db = str(tmp_path))
+    b.write_entries('studies', [{'study_id': 'S1', 'client': 'A'}, {'study_id': 'S2', 'client': 'B'}])
+    b.write_entries('study_employees', [{'study_id': 'S1', 'employee': 'E1', 'role': 'Director'},
+                                        {'study_id': 'S1', 'employee': None, 'role': 'Director'},
+                                        {'study_id': 'S2', 'employee': 'E2', 'role': None}])
+    b.save_all_tbls()
+
+    reopened = buildingAPI(str(tmp_path), ref_db = str(tmp_path))
+    assert reopened.assign_keys() == 5
+    assert reopened.assign_keys() == 0
+    reopened.save_all_tbls()
+
+    again = buildingAPI(str(tmp_path), ref_db = str(tmp_path))
+    assert again.assign_keys() == 0
+    assert again.count_entries('study_employees') == 3
+    assert again.database['study_employees']['study_key'].null_count() == 0
+
+class FailingStudy:
+
+    # Stands in for a scraped document. Writing its study fails after the document and study rows are written
+
+    def __init__(self, filepath, ref_db):
+        self.doc = None
+        self.study_id = 'S1'
+        self.study_date = None
+
+    def get_document_data(self):
+        raise RuntimeError('scrape failed')
+
+def test_add_filepath_leaves_nothing_when_it_fails(tmp_path, monkeypatch):
+    b = buildingAPI(str(tmp_path), ref_db = str(tmp_path))
+    b.save_all_tbls()
+    monkeypatch.setattr(study_scraping, 'MeliorStudy', FailingStudy)
+
+    def update_documents(ms, update = True):
+        b.write_entry('documents', {'document_id': 'S1_P00', 'study_id': ms.study_id, 'filepath': '/x/s1.docx'})
+        return True, {}, 'S1_P00'
+
+    def create_study_with_document(ms, doc_id):
+        b.write_entry('studies', {'study_id': ms.study_id, 'proposal_id': doc_id})
+        ms.get_document_data()
+
+    monkeypatch.setattr(b, 'update_documents', update_documents)
+    monkeypatch.setattr(b, 'create_study_with_document', create_study_with_document)
+    with pytest.raises(RuntimeError):
+        b.add_filepath('/x/s1.docx')
+
+    assert b.count_entries('documents') == 0 and b.count_entries('studies') == 0
+    assert b.get_dirty_tables() == []